@@ -0,0 +1,58 @@
+# Synthetic signals for the benchmarks. Every generator takes a sample count and a random state
+# and returns [samples, times] over one second.
+
+import numpy
+import scipy.signal
+
+from math import pi
+
+
+def square(n, rng):
+    t = numpy.linspace(0, 1, n)
+    return [scipy.signal.square(t * 50 * 2 * pi) + rng.normal(scale=0.01, size=n), t]
+
+
+def sine(n, rng):
+    t = numpy.linspace(0, 1, n)
+    return [numpy.sin(t * 50 * 2 * pi) + rng.normal(scale=0.01, size=n), t]
+
+
+def pulse_train(n, rng):
+    t = numpy.linspace(0, 1, n)
+    return [scipy.signal.square(t * 200 * 2 * pi, duty=0.1) + rng.normal(scale=0.01, size=n), t]
+
+
+def noisy(n, rng):
+    t = numpy.linspace(0, 1, n)
+    return [scipy.signal.square(t * 50 * 2 * pi) + rng.normal(scale=0.3, size=n), t]
+
+
+def multi_tone(n, rng):
+    t = numpy.linspace(0, 1, n)
+    freqs = [50, 130, 370, 1100]
+    y = sum(a * numpy.sin(t * f * 2 * pi + rng.uniform(0, 2 * pi)) for a, f in zip([1, 0.5, 0.2, 0.1], freqs))
+    return [y + rng.normal(scale=0.01, size=n), t]
+
+
+def outliers(n, rng):
+    y, t = square(n, rng)
+    spikes = rng.randint(0, n, max(n // 1000, 1))
+    y[spikes] += rng.normal(scale=50, size=len(spikes))
+    return [y, t]
+
+
+signals = {
+    'square': square,
+    'sine': sine,
+    'pulse train': pulse_train,
+    'noisy': noisy,
+    'multi-tone': multi_tone,
+    'outliers': outliers,
+}
+
+
+def spectrum(data):
+    # Power spectrum of a time series, as the frequency measurators expect it
+    fs = (len(data[1]) - 1) / (data[1][-1] - data[1][0])
+    f, p = scipy.signal.periodogram(data[0], fs, 'flattop', scaling='spectrum')
+    return [p[1:], f[1:]]
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Compare the per-sample and vectorised edge detectors on noisy square waves.
+# Usage: edges.py [samples ...], defaults to 1e4 1e6 1e8. The per-sample loop is
+# only timed up to --loop-max samples as it takes minutes at 1e8.
+
+import sys
+import timeit
+
+import numpy
+import scipy.signal
+
+from math import pi
+
+from wai.timeseries import TimeSeriesMeasurementSet, Edges, default_configuration
+
+args = sys.argv[1:]
+loop_max = 1e6
+if '--loop-max' in args:
+    i = args.index('--loop-max')
+    loop_max = float(args[i + 1])
+    del args[i:i + 2]
+
+sizes = [ int(float(s)) for s in args ] or [ int(1e4), int(1e6), int(1e8) ]
+
+for n in sizes:
+    t = numpy.linspace(0, 1, n)
+    y = scipy.signal.square(t * 1000 * 2 * pi) + numpy.random.normal(scale=0.05, size=n)
+
+    # Levels are shared by both detectors, so measure them up front
+    state = TimeSeriesMeasurementSet([y, t]).measure(['high level', 'low level'])
+    levels = { 'high level': state['high level'], 'low level': state['low level'] }
+
+    times = {}
+    for method in ['vector', 'loop']:
+        if method == 'loop' and n > loop_max:
+            continue
+        start = timeit.default_timer()
+        config = dict(default_configuration)
+        config['edge method'] = method
+        Edges().measure([y, t], dict(levels), config)
+        times[method] = timeit.default_timer() - start
+
+    line = "%10d samples: vector %.4fs" % (n, times['vector'])
+    if 'loop' in times:
+        line += ", loop %.4fs, speedup %.1fx" % (times['loop'], times['loop'] / times['vector'])
+    print(line)
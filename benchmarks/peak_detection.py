@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Speed and findings of each peak detection method on the spectra of the benchmark corpus. Only
+# peaks above 1e-4 are listed, being the tones and harmonics the signals were built from.
+# Usage: peak_detection.py [samples] [--no-cwt]
+
+import sys
+import timeit
+import warnings
+
+import numpy
+
+from wai.frequency import FrequencyMeasurementSet
+
+import corpus
+
+n = int(float(sys.argv[1])) if len(sys.argv) > 1 and not sys.argv[1].startswith('-') else 10000
+methods = ['ratio', 'prominence'] + ([] if '--no-cwt' in sys.argv else ['cwt'])
+
+warnings.simplefilter('ignore')
+
+for signal in sorted(corpus.signals):
+    data = corpus.spectrum(corpus.signals[signal](n, numpy.random.RandomState(0)))
+    print("%s, %d bins" % (signal, len(data[0])))
+
+    for method in methods:
+        m = FrequencyMeasurementSet(data, { 'peak method': method, 'peak interpolation': 'parabolic' })
+        m.measure('noise floor')
+        start = timeit.default_timer()
+        idxs = numpy.asarray(m.measure('peak idxs')['peak idxs'], dtype=int)
+        elapsed = timeit.default_timer() - start
+
+        tones = idxs[data[0][idxs] > 1e-4]
+        print("  %-10s %.4fs %4d peaks, tones at %s" % (method, elapsed, len(idxs), numpy.round(data[1][tones][:10]).astype(int)))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Accuracy and speed of the peak interpolation methods on multi-tone spectra with known,
+# off-bin tone frequencies and amplitudes.
+# Usage: peak_interpolation.py [tones] [samples]
+
+import sys
+import timeit
+
+import numpy
+import scipy.signal
+
+from wai.frequency import FrequencyMeasurementSet
+
+tones = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+n = int(float(sys.argv[2])) if len(sys.argv) > 2 else 65536
+
+rng = numpy.random.RandomState(0)
+t = numpy.arange(n)
+bins = numpy.sort(rng.choice(numpy.arange(50, n // 2 - 50, 40), tones, replace=False)) + rng.uniform(-0.5, 0.5, tones)
+amplitudes = rng.uniform(0.1, 1, tones)
+y = numpy.sum(amplitudes[:, None] * numpy.sin(2 * numpy.pi * bins[:, None] / n * t + rng.uniform(0, 2 * numpy.pi, tones)[:, None]), axis=0)
+y += rng.normal(scale=1e-3, size=n)
+
+for window in ['flattop', 'hann']:
+    f, p = scipy.signal.periodogram(y, 1., window, scaling='spectrum')
+    print("%s window, %d tones, %d bins" % (window, tones, len(f)))
+
+    for method in ['optimize', 'parabolic', 'gaussian']:
+        config = { 'peak method': 'ratio', 'peak ratio': 1000, 'peak interpolation': method }
+
+        m = FrequencyMeasurementSet([p, f], config)
+        m.measure('noise floor')
+        start = timeit.default_timer()
+        ms = m.measure('peak freqs')
+        elapsed = timeit.default_timer() - start
+
+        # Match each tone with the nearest peak found
+        found = numpy.asarray(ms['peak freqs']) * n
+        nearest = numpy.argmin(numpy.abs(found[None, :] - bins[:, None]), axis=1)
+
+        freq_err = numpy.abs(found[nearest] - bins)
+        level_err = numpy.abs(numpy.asarray(ms['peak amplitudes'])[nearest] / (amplitudes**2 / 2) - 1)
+        print("  %-10s %.4fs, %d peaks, frequency error max %.4f bins, level error max %.2f%%" % (
+            method, elapsed, len(found), freq_err.max(), level_err.max() * 100))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# Latency and frame drops of wai.aio.measure_stream on the fake frame source, for each queue
+# policy at a range of frame rates.
+# Usage: pipeline.py [frames] [samples]
+
+import asyncio
+import sys
+import warnings
+
+import numpy
+
+from wai import aio
+
+frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+samples = int(float(sys.argv[2])) if len(sys.argv) > 2 else 10000
+
+
+async def run(rate, policy):
+    source = aio.fake_frames(frames, rate=rate, samples=samples)
+    results = [ r async for r in aio.measure_stream(source, ['frequency', 'duty'], policy=policy) ]
+
+    latency = numpy.array([ r['latency'] for r in results ]) * 1e3
+    errors = sum(isinstance(r['result'], Exception) for r in results)
+    print("%-12s %6.0f frames/s: %4d measured, %4d dropped, %d errors, latency median %7.2fms, p99 %7.2fms" % (
+        policy, rate, len(results), results[-1]['dropped'], errors, numpy.median(latency), numpy.percentile(latency, 99)))
+
+
+warnings.simplefilter('ignore')
+for policy in [aio.DROP_OLDEST, aio.BLOCK]:
+    for rate in [10, 100, 1000]:
+        asyncio.run(run(rate, policy))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Time every measurator in wai.timeseries and wai.frequency on each signal in the corpus, write
+# the timings as JSON and optionally compare them against a saved baseline.
+#
+# Usage:
+#   run.py [--sizes 1e3 1e4 1e5 1e6] [--signals square sine ...] [--measurators Edges ...]
+#          [--repeat 3] [--max-seconds 10] [--output results.json]
+#          [--baseline baseline.json] [--threshold 0.25] [--threshold 'frequency.*=0.5']
+#
+# Each timing is the best of --repeat runs of the measurator alone, with its requirements
+# measured beforehand. Once a measurator takes longer than --max-seconds on a signal, larger
+# sizes of that signal are skipped for it. Frequency measurators run on the flattop power
+# spectrum of each signal.
+#
+# With --baseline, any timing more than its threshold (a fraction, 0.25 being 25% slower) over the
+# baseline is reported and the exit status is 1. Thresholds given as pattern=fraction apply to
+# the timings whose 'module.Measurator/signal/size' name matches the pattern.
+
+import argparse
+import fnmatch
+import json
+import platform
+import sys
+import timeit
+import warnings
+
+import numpy
+import scipy
+
+import wai.frequency
+import wai.timeseries
+
+import corpus
+
+# Timings below this are dominated by noise and never count as regressions
+noise_floor = 1e-4
+
+
+def families():
+    yield 'timeseries', wai.timeseries._TimeSeriesMeasurator, wai.timeseries.TimeSeriesMeasurementSet
+    yield 'frequency', wai.frequency._FrequencyMeasurator, wai.frequency.FrequencyMeasurementSet
+
+
+def time_measurator(cl, measurement_set, data, repeat):
+    m = measurement_set(data)
+    if cl.requires:
+        m.measure(cl.requires)
+
+    best = None
+    for _ in range(repeat):
+        state = dict(m.state)
+        start = timeit.default_timer()
+        cl().measure(data, state, m.configuration)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def run(args):
+    results = {}
+    errors = {}
+
+    for size in args.sizes:
+        for signal in args.signals:
+            data = corpus.signals[signal](size, numpy.random.RandomState(0))
+            spectrum = None
+
+            for family, base_class, measurement_set in families():
+                for cl in base_class.all_measurators():
+                    if args.measurators and cl.__name__ not in args.measurators:
+                        continue
+
+                    name = '%s.%s/%s' % (family, cl.__name__, signal)
+                    key = '%s/%d' % (name, size)
+                    if name in errors or results.get(name + '/skip'):
+                        continue
+
+                    if family == 'frequency' and spectrum is None:
+                        spectrum = corpus.spectrum(data)
+
+                    try:
+                        elapsed = time_measurator(cl, measurement_set, spectrum if family == 'frequency' else data, args.repeat)
+                    except Exception as e:
+                        errors[name] = repr(e)
+                        print("%-50s error: %r" % (key, e))
+                        continue
+
+                    results[key] = elapsed
+                    if elapsed > args.max_seconds:
+                        results[name + '/skip'] = True
+                    print("%-50s %.6fs" % (key, elapsed))
+                    sys.stdout.flush()
+
+    return dict((k, v) for k, v in results.items() if not k.endswith('/skip')), errors
+
+
+def thresholds(args):
+    default, patterns = 0.25, []
+    for t in args.threshold:
+        if '=' in t:
+            pattern, value = t.rsplit('=', 1)
+            patterns.append((pattern, float(value)))
+        else:
+            default = float(t)
+
+    def threshold(key):
+        for pattern, value in patterns:
+            if fnmatch.fnmatch(key, pattern):
+                return value
+        return default
+
+    return threshold
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key in sorted(set(results) & set(baseline)):
+        new, old = results[key], baseline[key]
+        if new > noise_floor and new > old * (1 + threshold(key)):
+            regressions.append(key)
+            print("REGRESSION %-50s %.6fs -> %.6fs (%+.0f%%)" % (key, old, new, (new / old - 1) * 100))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=lambda s: int(float(s)), default=[ int(1e3), int(1e4), int(1e5), int(1e6) ])
+    parser.add_argument('--signals', nargs='+', choices=sorted(corpus.signals), default=sorted(corpus.signals))
+    parser.add_argument('--measurators', nargs='+', default=[])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-seconds', type=float, default=10.)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', action='append', default=[])
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    results, errors = run(args)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+        },
+        'results': results,
+        'errors': errors,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, thresholds(args)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Runtime and parameter accuracy of the sine fit methods on noisy sines with known parameters.
+# Usage: sine_fit.py [samples ...], defaults to 1e4 1e5 1e6
+
+import sys
+import timeit
+
+import numpy
+
+from math import pi
+
+from wai.timeseries import TimeSeriesMeasurementSet
+
+sizes = [ int(float(s)) for s in sys.argv[1:] ] or [ int(1e4), int(1e5), int(1e6) ]
+rng = numpy.random.RandomState(0)
+
+configurations = [
+    ('curve_fit', { 'sine fit': 'curve_fit' }),
+    ('linear', { 'sine fit': 'linear' }),
+    ('iterative', { 'sine fit': 'iterative' }),
+    ('iterative /10', { 'sine fit': 'iterative', 'sine fit decimation': 10 }),
+    ('iterative cycles', { 'sine fit': 'iterative', 'sine fit cycles': True }),
+]
+
+for n in sizes:
+    t = numpy.linspace(0, 1, n)
+    freq, amplitude, phase, offset = rng.uniform(5, 50), rng.uniform(0.5, 2), rng.uniform(0, 2 * pi), rng.uniform(-1, 1)
+    y = amplitude * numpy.sin(2 * pi * freq * t + phase) + offset + rng.normal(scale=0.05 * amplitude, size=n)
+
+    # Measure the fit's requirements once so only the fit is timed
+    state = TimeSeriesMeasurementSet([y, t]).measure(['frequency', 'cycle mean', 'amplitude', 'rising edge'])
+
+    print("%d samples" % n)
+    for name, config in configurations:
+        m = TimeSeriesMeasurementSet([y, t], config)
+        m.state.update(state)
+        start = timeit.default_timer()
+        ms = m.measure('sine frequency')
+        elapsed = timeit.default_timer() - start
+
+        if ms['sine frequency'] is None:
+            print("  %-17s %.4fs, no fit" % (name, elapsed))
+            continue
+
+        phase_err = (ms['sine phase'] - phase + pi) % (2 * pi) - pi
+        print("  %-17s %.4fs, errors: frequency %.2e, amplitude %.2e, phase %.2e, offset %.2e" % (
+            name, elapsed, abs(ms['sine frequency'] / freq - 1), abs(ms['sine amplitude'] / amplitude - 1),
+            abs(phase_err), abs(ms['sine offset'] - offset)))
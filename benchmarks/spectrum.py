@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Throughput of wai.spectrum against a scipy.signal.periodogram call per capture.
+# Usage: spectrum.py [captures] [samples]
+
+import sys
+import timeit
+
+import numpy
+import scipy.signal
+
+from wai.spectrum import spectrum
+
+captures = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+n = int(float(sys.argv[2])) if len(sys.argv) > 2 else 4096
+
+y = numpy.random.RandomState(0).normal(size=(captures, n))
+config = { 'sample rate': 1. }
+
+start = timeit.default_timer()
+expected = [ scipy.signal.periodogram(row, 1., 'flattop', scaling='spectrum')[1] for row in y ]
+periodogram = timeit.default_timer() - start
+
+start = timeit.default_timer()
+single = [ spectrum(row, config)[0] for row in y ]
+each = timeit.default_timer() - start
+
+start = timeit.default_timer()
+batch = spectrum(y, config)[0]
+together = timeit.default_timer() - start
+
+assert numpy.allclose(expected, single) and numpy.allclose(expected, batch)
+
+print("%d captures of %d samples" % (captures, n))
+print("periodogram per capture: %.4fs" % periodogram)
+print("spectrum per capture:    %.4fs (%.1fx)" % (each, periodogram / each))
+print("spectrum of the batch:   %.4fs (%.1fx)" % (together, periodogram / together))
@@ -22,7 +22,7 @@ setup(
 	keywords=['moku', 'liquid instruments', 'test', 'measurement', 'lab', 'equipment'],
 
 	install_requires=[
-		'numpy>=1.11.0',
+		'numpy>=1.15.0',
         'scipy',
 	],
 )
@@ -7,7 +7,7 @@ from pylab import *
 
 import scipy.signal
 import numpy
-import time
+import timeit
 
 from math import pi
 
@@ -18,9 +18,9 @@ data = [scipy.signal.square(t * 5 * 2 * pi) + n, t]
 # data = [[0, 0, 1, 1, 0, 0, 1, 1], [0,1,2,3,4,5,6,7]]
 m = TimeSeriesMeasurementSet(data)
 
-start = time.clock()
+start = timeit.default_timer()
 ms = m.measure()
-print(time.clock() - start)
+print(timeit.default_timer() - start)
 print(ms)
 
 for r in [ ((r, r),(-1, 1)) for r in ms['rising edge idx']]:
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Checks that measure_stream keeps measuring frames from sources that never suspend, rather than
+# starving its consumer. Runs as a script, or under pytest.
+
+import asyncio
+
+from wai.aio import measure_stream, fake_frames, BLOCK, DROP_OLDEST
+
+
+async def never_suspends(count=None):
+    # Frames as fast as they can be made, without ever yielding to the event loop
+    async for frame in fake_frames(1, samples=20000):
+        pass
+    i = 0
+    while count is None or i < count:
+        yield frame
+        i += 1
+
+
+async def first_result(frames, policy):
+    stream = measure_stream(frames, ['frequency'], queue_size=2, policy=policy)
+    try:
+        async for result in stream:
+            return result
+    finally:
+        await stream.aclose()
+
+
+def test_endless_fast_source():
+    for policy in [DROP_OLDEST, BLOCK]:
+        for frames in [never_suspends(), fake_frames(rate=1e6, samples=20000)]:
+            result = asyncio.run(asyncio.wait_for(first_result(frames, policy), 5))
+            assert not isinstance(result['result'], Exception)
+
+
+def test_fast_source_measures_throughout():
+    async def run():
+        return [ r async for r in measure_stream(fake_frames(50, rate=2000, samples=20000), ['frequency']) ]
+
+    results = asyncio.run(asyncio.wait_for(run(), 30))
+    assert results[0]['frame'] < 10
+    assert results[-1]['frame'] == 49
+
+
+if __name__ == '__main__':
+    test_endless_fast_source()
+    test_fast_source_measures_throughout()
+    print("ok")
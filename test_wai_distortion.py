@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+# Known answers for the harmonic analysis: a tone with a -40 dB second and a -50 dB third
+# harmonic, on a bin and between bins, through the windows whose skirts differ most. Runs as a
+# script, or under pytest.
+
+import numpy
+
+from wai.spectrum import frequency_measurement_set
+
+fs, n = 1000., 8192
+t = numpy.arange(n) / fs
+
+
+def analyse(f0, window):
+    y = numpy.sin(2 * numpy.pi * f0 * t) + 0.01 * numpy.sin(4 * numpy.pi * f0 * t + 1) + \
+        10 ** (-50. / 20) * numpy.sin(6 * numpy.pi * f0 * t)
+    return frequency_measurement_set(y, { 'spectrum window': window, 'sample rate': fs }).measure(
+        ['fundamental frequency', 'thd', 'thd+n', 'sfdr'])
+
+
+def test_known_answers():
+    thd = 10 * numpy.log10(10 ** -4. + 10 ** -5.)
+    for window in ['hann', 'flattop']:
+        for f0 in [300 * fs / n, 37.3, 101.7]:
+            r = analyse(f0, window)
+            assert abs(r['fundamental frequency'] - f0) < 1e-3, (window, f0, r['fundamental frequency'])
+            assert abs(r['thd'] - thd) < 0.05, (window, f0, r['thd'])
+            assert abs(r['thd+n'] - thd) < 0.1, (window, f0, r['thd+n'])
+            assert abs(r['sfdr'] - 40) < 0.1, (window, f0, r['sfdr'])
+
+
+if __name__ == '__main__':
+    test_known_answers()
+    print("ok")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Checks that the vectorised edge detector finds the same edges as the per-sample loop, and that
+# the searchsorted pulse pairing finds the same pulses as the original merge of the edge lists.
+# Runs as a script, or under pytest.
+
+import numpy
+
+from wai.timeseries import Edges, PulseStatistics, default_configuration
+
+
+def pairs_by_merge(re, fe):
+    # PulseStatistics' original pairing, popping whichever edge list has the earlier head
+    re, fe = list(re), list(fe)
+    pos, neg = [], []
+
+    while len(re) and len(fe):
+        if re[0] < fe[0]:
+            pos.append(fe[0] - re[0])
+            re.pop(0)
+        else:
+            neg.append(re[0] - fe[0])
+            fe.pop(0)
+
+    return pos, neg
+
+
+def signals(count):
+    # Noisy square waves, slow noisy ramps, random walks and quantised waves whose samples land
+    # exactly on the thresholds, in floats and integer codes
+    rng = numpy.random.RandomState(0)
+    for i in range(count):
+        n = rng.randint(2, 3000)
+        t = numpy.cumsum(rng.uniform(0.5, 1.5, n))
+        kind = i % 4
+
+        if kind == 0:
+            y = numpy.sign(numpy.sin(t * rng.uniform(0.01, 0.5))) + rng.normal(scale=rng.uniform(0, 0.8), size=n)
+        elif kind == 1:
+            y = numpy.sin(t * rng.uniform(0.001, 0.05)) + rng.normal(scale=0.1, size=n)
+        elif kind == 2:
+            y = numpy.cumsum(rng.normal(size=n))
+        else:
+            # Levels 0 and 10 put the thresholds on the codes 1 and 9
+            y = numpy.clip(numpy.round(5 + 6 * numpy.sign(numpy.sin(t * 0.2)) + rng.normal(scale=2, size=n)), 0, 10)
+            if i % 8 == 3:
+                y = y.astype(numpy.int16)
+            yield y, t, 0., 10.
+            continue
+
+        yield y, t, float(numpy.min(y)), float(numpy.max(y))
+
+
+def test_vector_edges_match_loop():
+    for y, t, low, high in signals(300):
+        found = {}
+        for method in ['loop', 'vector']:
+            config = dict(default_configuration)
+            config['edge method'] = method
+            state = { 'low level': low, 'high level': high }
+            Edges().measure([y, t], state, config)
+            found[method] = state
+
+        for k in ['rising edge idx', 'falling edge idx']:
+            assert list(found['loop'][k]) == list(found['vector'][k]), k
+        for k in ['rising edge', 'falling edge', 'rise times', 'fall times']:
+            assert numpy.allclose(found['loop'][k], found['vector'][k], rtol=1e-12, atol=0), k
+
+
+def test_pulse_pairing_matches_merge():
+    rng = numpy.random.RandomState(1)
+    for i in range(500):
+        # Edge times on a coarse grid, so rising and falling edges often coincide
+        re = numpy.sort(rng.randint(0, rng.randint(1, 200), rng.randint(0, 40))).astype(float)
+        fe = numpy.sort(rng.randint(0, rng.randint(1, 200), rng.randint(0, 40))).astype(float)
+
+        state = { 'rising edge': tuple(re), 'falling edge': tuple(fe) }
+        PulseStatistics().measure(None, state, default_configuration)
+
+        pos, neg = pairs_by_merge(re, fe)
+        assert list(state['pos widths']) == pos
+        assert list(state['neg widths']) == neg
+
+
+if __name__ == '__main__':
+    test_vector_edges_match_loop()
+    test_pulse_pairing_matches_merge()
+    print("ok")
@@ -7,7 +7,7 @@ from pylab import *
 
 import scipy.signal
 import numpy
-import time
+import timeit
 
 from math import pi
 
@@ -26,9 +26,9 @@ config = {
 
 m = FrequencyMeasurementSet([p, f], configuration=config)
 
-start = time.clock()
+start = timeit.default_timer()
 ms = m.measure()
-print(time.clock() - start)
+print(timeit.default_timer() - start)
 print(ms)
 
 semilogy(f, p)
@@ -1,3 +1,23 @@
+import time
+import timeit
+
+import numpy
+
+from wai.timebase import TimeBase
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    _cpu_time = time.clock
+
+# CPU time of the calling thread alone, where the platform has it
+_thread_time = getattr(time, 'thread_time', None)
+
 
 class _Measurator(object):
     provides = []
@@ -12,10 +32,167 @@ class _Measurator(object):
                 yield m
             yield subclass
 
+    @classmethod
+    def requirements(cls, configuration):
+        # What measure() needs under this configuration: everything in requires, unless the
+        # measurator can do without some of it
+        return cls.requires
+
     def measure(self, data, state, configuration):
         pass
 
 
+def _samples_only(data):
+    # Whether data is samples alone rather than a [samples, times] pair. Two scalars are two
+    # samples, not a pair, and a 2-D array is a batch of captures even when it has two rows.
+    if isinstance(data, numpy.ndarray) and data.ndim == 2:
+        return True
+    return len(data) != 2 or numpy.ndim(data[0]) == 0
+
+
+def _column(values):
+    # Per-capture results from a batch: scalars are gathered into an array with one entry per
+    # capture, anything else (per-edge sequences, missing values) stays a list
+    if all(v is not None and numpy.ndim(v) == 0 for v in values):
+        return numpy.array(values)
+    return values
+
+
+# Execution plans, built once per family of measurators and requested measurement set
+_families = {}
+_plans = {}
+
+
+def _family(measurators):
+    # The first measurator to provide each key, as the old recursive search would find it
+    if measurators not in _families:
+        providers = {}
+        for cl in measurators:
+            for p in cl.provides:
+                providers.setdefault(p, cl)
+        _families[measurators] = providers
+
+    return _families[measurators]
+
+
+def _build_plan(measurators, measurements, configuration):
+    providers = _family(measurators)
+
+    roots = []
+    for m in measurements:
+        if m == 'all':
+            roots.extend(measurators)
+        elif m in providers:
+            roots.append(providers[m])
+        else:
+            raise Exception("Can't find provider for {}".format(m))
+
+    # Depth-first walk of the requirements, appending each measurator after everything it
+    # requires so the plan is topologically sorted
+    order = []
+    visiting = []
+
+    def visit(cl):
+        if cl in order:
+            return
+        if cl in visiting:
+            cycle = visiting[visiting.index(cl):] + [cl]
+            raise Exception("Circular measurement dependency: {}".format(' -> '.join(c.__name__ for c in cycle)))
+
+        visiting.append(cl)
+        for r in cl.requirements(configuration):
+            if r not in providers:
+                raise Exception("Can't find provider for {}, required by {}".format(r, cl.__name__))
+            visit(providers[r])
+        visiting.pop()
+        order.append(cl)
+
+    for cl in roots:
+        visit(cl)
+
+    return [ cl() for cl in order ]
+
+
+def _plan(base_class, measurements, configuration):
+    # Keyed on the measurators currently defined so that later subclasses are picked up, and on
+    # what each requires under the configuration
+    measurators = tuple(base_class.all_measurators())
+    requirements = tuple( tuple(cl.requirements(configuration)) for cl in measurators )
+    key = (measurators, frozenset(measurements), requirements)
+    if key not in _plans:
+        _plans[key] = _build_plan(measurators, measurements, configuration)
+
+    return _plans[key]
+
+
+# Thread pools for the 'workers' option, one per pool size, kept for the life of the process
+_executors = {}
+
+
+def _executor(workers):
+    if workers not in _executors:
+        from concurrent.futures import ThreadPoolExecutor
+        _executors[workers] = ThreadPoolExecutor(workers)
+
+    return _executors[workers]
+
+
+def _profile_start(memory, clock=_cpu_time):
+    allocated = None
+    if memory:
+        import tracemalloc
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+
+    return timeit.default_timer(), clock, clock() if clock else None, allocated
+
+
+def _profile_stop(name, start):
+    wall, clock, cpu, allocated = start
+    record = {
+        'name': name,
+        'wall': timeit.default_timer() - wall,
+        'cpu': clock() - cpu if clock else None,
+        'peak alloc': None,
+    }
+
+    if allocated is not None:
+        import tracemalloc
+        record['peak alloc'] = tracemalloc.get_traced_memory()[1] - allocated
+
+    return record
+
+
+class _LazyResult(Mapping):
+    # Read-only view of a measurement set that measures each key on first access, along with
+    # whatever it requires. Everything measured is kept in the set's state, so intermediates are
+    # shared between keys.
+    def __init__(self, measurement_set):
+        self._set = measurement_set
+        self._keys = list(_family(tuple(measurement_set.base_class.all_measurators())))
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key not in self._set.state:
+            self._set.measure([key])
+        return self._set._scale(self._set.state)[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        measured = [ k for k in self._keys if k in self._set.state ]
+        return '<lazy measurements, %d of %d measured: %s>' % (len(measured), len(self._keys), ', '.join(measured))
+
+
 class _BaseMeasurementSet(object):
 
     def __init__(self, base_class, data, configuration=None):
@@ -25,55 +202,159 @@ class _BaseMeasurementSet(object):
 
         self.state = {}
 
+        # Per-measurator timings, accumulated over measure() calls when the 'profile'
+        # configuration option is set
+        self.profile = { 'dependencies': {}, 'measurators': {} }
 
-    def _deps_satisfied(self, measurement, state):
-        for r in measurement.requires:
-            if not r in state:
-                return False
+    def _measure_batch(self, measurator, state):
+        # Data holds many same-length captures, one per row. Measurators that can handle all rows
+        # at once provide measure_batch, everything else is run capture by capture.
+        if hasattr(measurator, 'measure_batch'):
+            measurator.measure_batch(self.data, state, self.configuration)
+            return
 
-        return True
+        rows = []
+        for i, row in enumerate(self.data[0]):
+            row_state = dict((r, state[r][i]) for r in measurator.requirements(self.configuration))
+            measurator.measure([row, self.data[1]], row_state, self.configuration)
+            rows.append(row_state)
+
+        for p in measurator.provides:
+            state[p] = _column([ r[p] for r in rows ])
 
-    def _provider(self, m):
-        for cl in self.base_class.all_measurators():
-            if m in cl.provides:
-                required = set([cl])
-                for req in cl.requires:
-                    required |= self._provider(req)
-                return required
+    def _measure_one(self, measurator, state, batch, profile, memory, clock=_cpu_time):
+        if profile:
+            start = _profile_start(memory, clock)
+
+        if batch:
+            self._measure_batch(measurator, state)
         else:
-            raise Exception("Can't find provider for {}".format(m))
+            measurator.measure(self.data, state, self.configuration)
+
+        return _profile_stop(type(measurator).__name__, start) if profile else None
+
+    def _measure_parallel(self, measurators, workers, batch, profile, memory):
+        # Runs each measurator on the thread pool as soon as everything it requires has been
+        # measured. Every measurator works on its own copy of the state, and results are merged
+        # in plan order, so the outcome doesn't depend on which thread finishes first.
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        executor = _executor(workers)
+        order = dict((m, i) for i, m in enumerate(measurators))
+        waiting = list(measurators)
+        running = {}
+
+        while waiting or running:
+            for m in [ m for m in waiting if all(r in self.state for r in m.requirements(self.configuration)) ]:
+                waiting.remove(m)
+                state = dict(self.state)
+                running[executor.submit(self._measure_one, m, state, batch, profile, memory, _thread_time)] = m, state
+
+            if not running:
+                raise Exception("Can't satisfy the requirements of {}".format(', '.join(type(m).__name__ for m in waiting)))
+
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in sorted(done, key=lambda f: order[running[f][0]]):
+                m, state = running.pop(future)
+                record = future.result()
+                for k, v in state.items():
+                    if k not in self.state:
+                        self.state[k] = v
+                if record is not None:
+                    self._profile_record(record)
+
+    def _profile_record(self, record, dependencies=False):
+        stats = self.profile['dependencies'] if dependencies else self.profile['measurators'].setdefault(record['name'], {})
+
+        stats['calls'] = stats.get('calls', 0) + 1
+        stats['wall'] = stats.get('wall', 0) + record['wall']
+        if record['cpu'] is not None:
+            stats['cpu'] = stats.get('cpu', 0) + record['cpu']
+        if record['peak alloc'] is not None:
+            stats['peak alloc'] = max(stats.get('peak alloc', 0), record['peak alloc'])
+
+        callback = self.configuration['profile']
+        if callable(callback):
+            callback(record)
 
     def measure(self, measurements='all'):
 
         if isinstance(measurements, str):
             measurements = [measurements]
 
-        measurement_classes = set()
-        for m in measurements:
-            if m == 'all':
-                measurement_classes |= set(self.base_class.all_measurators())
-            else:
-                measurement_classes |= self._provider(m)
+        # Instrumentation is off unless asked for, leaving one test per measurator
+        profile = self.configuration.get('profile') if self.configuration else None
+        memory = bool(profile) and self.configuration.get('profile memory', False)
 
-        # Instantiate all required classes. We'll keep the objects
-        # around in the future so more data can be added
-        self._measurators = [ cls() for cls in measurement_classes ]
+        # Allocation tracing slows everything down, so only trace for the length of the call
+        traced = False
+        if memory:
+            import tracemalloc
+            traced = not tracemalloc.is_tracing()
+            if traced:
+                tracemalloc.start()
 
-        to_measure = set(self._measurators)
+        if profile:
+            start = _profile_start(memory)
+
+        # Measurator objects are stateless, so the plan's instances are shared
+        # between measurement sets
+        self._measurators = _plan(self.base_class, measurements, self.configuration)
+
+        if profile:
+            self._profile_record(_profile_stop('dependencies', start), dependencies=True)
+
+        # Samples alone, rather than a [samples, times] pair, are given a uniform time base
+        if _samples_only(self.data):
+            rate = self.configuration.get('sample rate') if self.configuration else None
+            self.data = [self.data, TimeBase.from_rate(rate) if rate else TimeBase()]
+
+        if isinstance(self.data[1], TimeBase) and self.data[1].n is None:
+            self.data = [self.data[0], self.data[1].resized(numpy.shape(self.data[0])[-1])]
+
+        # A 2-D sample array is a batch of captures sharing the one x-axis
+        batch = numpy.ndim(self.data[0]) == 2
+
+        cache = self.configuration.get('cache') if self.configuration else None
+        if cache is not None:
+            key = cache.key(self.base_class, self.data, self.configuration)
+            for k, v in cache.get(key).items():
+                self.state.setdefault(k, v)
+
+        pending = []
+        for m in self._measurators:
+            # Skip anything already measured, whether by an earlier call or from the cache
+            if all(p in self.state for p in m.provides):
+                if cache is not None:
+                    cache.hits += 1
+                continue
+            elif cache is not None:
+                cache.misses += 1
+            pending.append(m)
+
+        workers = self.configuration.get('workers') if self.configuration else None
+        if workers and workers > 1 and len(pending) > 1:
+            # Allocation tracing and process CPU time are process wide, so measurators running side
+            # by side would count each other's. Their records have no 'peak alloc', and 'cpu' is
+            # the time of the thread each ran on.
+            self._measure_parallel(pending, workers, batch, profile, False)
+        else:
+            for m in pending:
+                record = self._measure_one(m, self.state, batch, profile, memory)
+                if record is not None:
+                    self._profile_record(record)
 
-        if len(self.data) != 2:
-            self.data = [self.data, range(len(self.data))]
+        if cache is not None:
+            cache.put(key, self.state)
 
-        while len(to_measure):
-            processed = set()
-            for try_measure in to_measure:
-                if self._deps_satisfied(try_measure, self.state):
-                    try_measure.measure(self.data, self.state, self.configuration)
-                    processed |= set([try_measure])
+        if traced:
+            tracemalloc.stop()
 
-            if not len(processed):
-                raise Exception("Can't make progress through measurements, must be an invalid configuration somewhere")
+        return self._scale(self.state)
 
-            to_measure -= processed
+    def _scale(self, state):
+        # Results as reported, from the state measurements are made in
+        return state
 
-        return self.state
+    def lazy(self):
+        return _LazyResult(self)
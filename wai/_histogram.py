@@ -0,0 +1,113 @@
+import numpy
+
+from math import ceil, sqrt
+
+# Points histogrammed per pass of the block loop, as numpy.histogram does internally
+_block = 65536
+
+
+def _bin_count(bins, n, x=None):
+    # Number of equal-width bins for an n point histogram. Rules that only depend on the point
+    # count don't need the points themselves.
+    if numpy.ndim(bins):
+        raise Exception("Histogram bins given as edges have no bin count rule")
+    elif isinstance(bins, int):
+        return bins
+    elif bins == 'sqrt':
+        return int(ceil(sqrt(n)))
+    elif bins == 'sturges':
+        return int(ceil(numpy.log2(n))) + 1
+    elif bins == 'rice':
+        return int(ceil(2 * n ** (1. / 3)))
+    elif x is None:
+        raise Exception("Need the data to find a bin count for %s" % bins)
+    else:
+        return len(numpy.histogram_bin_edges(x, bins)) - 1
+
+
+def _code_counts(y, lo, hi):
+    # Count of each integer code in y from lo to hi. Codes are widened to indices a block at a
+    # time, rather than all at once.
+    counts = numpy.zeros(hi - lo + 1, dtype=numpy.intp)
+    for i in range(0, len(y), _block):
+        counts += numpy.bincount(numpy.subtract(y[i:i + _block], lo, dtype=numpy.intp), minlength=len(counts))
+    return counts
+
+
+def _range(lo, hi):
+    # Histogram range as numpy.histogram chooses it, widened when all points are equal
+    return (lo - 0.5, hi + 0.5) if lo == hi else (lo, hi)
+
+
+def _counts(x, histograms):
+    # Counts for several histograms of x from a single pass over it. Each histogram is given as
+    # (lo, hi, bins, log) for bins equal-width bins over [lo, hi] or, with log, bins equal-width
+    # in log(x) over the same range. Logarithms are taken a block at a time rather than of the
+    # whole array.
+    counts = [ numpy.zeros(bins, dtype=numpy.intp) for lo, hi, bins, log in histograms ]
+
+    for i in range(0, len(x), _block):
+        block = x[i:i + _block]
+        log_block = None
+
+        for c, (lo, hi, bins, log) in zip(counts, histograms):
+            if log:
+                if log_block is None:
+                    log_block = numpy.log(block)
+                values, lo, hi = log_block, numpy.log(lo), numpy.log(hi)
+            else:
+                values = block
+
+            idx = ((values - lo) * (bins / (hi - lo))).astype(numpy.intp)
+            numpy.clip(idx, 0, bins - 1, out=idx)
+            c += numpy.bincount(idx, minlength=bins)
+
+    return counts
+
+
+def _row_histogram(y, lo, hi, bins):
+    # numpy.histogram applied independently to each row of y, with bins equal-width bins
+    # spanning that row's [lo, hi]
+    lo, hi = numpy.where(lo == hi, lo - 0.5, lo), numpy.where(lo == hi, hi + 0.5, hi)
+    step = (hi - lo) / bins
+
+    idx = ((y - lo[:, None]) / step[:, None]).astype(numpy.intp)
+    numpy.clip(idx, 0, bins - 1, out=idx)
+    idx += numpy.arange(len(y))[:, None] * bins
+
+    counts = numpy.bincount(idx.ravel(), minlength=len(y) * bins).reshape(len(y), bins)
+    edges = lo[:, None] + numpy.arange(bins + 1) * step[:, None]
+    edges[:, -1] = hi
+
+    return counts, edges
+
+
+def _coarsen(counts, factor):
+    # Merge each group of factor neighbouring bins, along the last axis
+    return counts.reshape(counts.shape[:-1] + (-1, factor)).sum(axis=-1)
+
+
+def _concentrated(counts):
+    # Whether a single bin holds 80% or more of the points in either half of the histogram,
+    # for each row of counts
+    split = int(counts.shape[-1] / 2)
+    bottom, top = counts[..., :split], counts[..., split:]
+    return (bottom.max(axis=-1) >= 0.8 * bottom.sum(axis=-1)) | (top.max(axis=-1) >= 0.8 * top.sum(axis=-1))
+
+
+def _refine(fine, refinements):
+    # fine holds counts at 2**refinements times the starting bin count. Finds, for each row, the
+    # coarsest of the starting count and its doublings that isn't concentrated in the sense above,
+    # by merging fine bins rather than going back to the data. Rows still concentrated after the
+    # last check use the finest bins. Returns the number of doublings used per row and whether
+    # each row ended up there without passing.
+    levels = numpy.zeros(fine.shape[:-1], dtype=int)
+    pending = numpy.ones(fine.shape[:-1], dtype=bool)
+
+    for level in range(refinements):
+        ok = ~_concentrated(_coarsen(fine, 2**(refinements - level))) & pending
+        levels[ok] = level
+        pending &= ~ok
+
+    levels[pending] = refinements
+    return levels, pending
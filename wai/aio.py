@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import numpy
+
+from wai.timebase import TimeBase
+
+# Queue policies for frames arriving faster than they can be measured
+DROP_OLDEST = 'drop oldest'
+BLOCK = 'block'
+
+_done = object()
+
+
+def _measure(measurement_set, data, measurements, configuration):
+    started = time.perf_counter()
+    try:
+        result = measurement_set(data, configuration).measure(measurements)
+    except Exception as e:
+        result = e
+    return result, started, time.perf_counter()
+
+
+async def fake_frames(count=None, rate=100., samples=1000, frequency=50., sample_rate=10e3, noise=0.05, seed=0):
+    # Square wave captures at a steady frame rate, standing in for an instrument. Each frame is
+    # [samples, time base] with a random phase. Runs forever when count is None.
+    rng = numpy.random.RandomState(seed)
+    times = TimeBase.from_rate(sample_rate, n=samples)
+    t = numpy.asarray(times)
+
+    start = time.perf_counter()
+    i = 0
+    while count is None or i < count:
+        # Always suspend, even when behind, as an instrument read would
+        await asyncio.sleep(max(start + i / rate - time.perf_counter(), 0))
+
+        phase = rng.uniform(0, 2 * numpy.pi)
+        y = numpy.sign(numpy.sin(2 * numpy.pi * frequency * t + phase)) + rng.normal(scale=noise, size=samples)
+        yield [y, times]
+        i += 1
+
+
+async def measure_stream(frames, measurements='all', configuration={}, measurement_set=None,
+                         queue_size=4, policy=DROP_OLDEST, executor=None):
+    # Measure frames from an async iterator as they arrive, yielding a dict per measured frame:
+    # its sequence number, the measurement results (or the exception measuring it raised), when
+    # it was received, started and finished on the perf_counter clock, its latency from receipt
+    # to result and the number of frames dropped so far.
+    #
+    # Frames wait in a queue of queue_size while an earlier frame is measured in the executor,
+    # the event loop's default one if None. When the queue is full, DROP_OLDEST discards the
+    # oldest waiting frame to make room and BLOCK stops reading frames until there is room.
+    #
+    # Stopping early, by closing the returned generator, stops reading frames and closes the
+    # frame source.
+    if measurement_set is None:
+        from wai.timeseries import TimeSeriesMeasurementSet as measurement_set
+
+    if policy not in [DROP_OLDEST, BLOCK]:
+        raise Exception("Unknown queue policy %s" % policy)
+
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(queue_size)
+    dropped = [0]
+
+    async def acquire():
+        try:
+            seq = 0
+            async for data in frames:
+                item = (seq, time.perf_counter(), data)
+                if policy == DROP_OLDEST and queue.full():
+                    queue.get_nowait()
+                    dropped[0] += 1
+                    queue.put_nowait(item)
+                else:
+                    await queue.put(item)
+                seq += 1
+
+                # Neither branch need suspend, so give the consumer a turn with every frame in
+                # case the frame source doesn't either
+                await asyncio.sleep(0)
+        except Exception:
+            # Make room for the end of frames if need be, so the error reaches the consumer
+            if queue.full():
+                queue.get_nowait()
+                dropped[0] += 1
+            queue.put_nowait(_done)
+            raise
+        finally:
+            if hasattr(frames, 'aclose'):
+                await frames.aclose()
+
+        await queue.put(_done)
+
+    producer = asyncio.ensure_future(acquire())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _done:
+                break
+
+            seq, received, data = item
+            result, started, finished = await loop.run_in_executor(
+                executor, _measure, measurement_set, data, measurements, configuration)
+
+            yield {
+                'frame': seq,
+                'result': result,
+                'received': received,
+                'started': started,
+                'finished': finished,
+                'latency': finished - received,
+                'dropped': dropped[0],
+            }
+
+        # Surface any error from the frame source
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+            await asyncio.wait([producer])
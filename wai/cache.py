@@ -0,0 +1,95 @@
+import hashlib
+import sys
+import threading
+
+from collections import OrderedDict
+
+import numpy
+
+from wai.timebase import TimeBase
+
+
+def _nbytes(value):
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_nbytes(v) for v in value)
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_nbytes(v) for v in value.values())
+    else:
+        return sys.getsizeof(value)
+
+
+def _fingerprint(h, x):
+    if isinstance(x, TimeBase):
+        h.update(repr(x).encode())
+        return
+
+    a = numpy.ascontiguousarray(x)
+    h.update(str((a.dtype.str, a.shape)).encode())
+    h.update(a.data if a.dtype != object else repr(a.tolist()).encode())
+
+
+class ResultCache(object):
+    # Measurement results shared between measure() calls and measurement sets. Entries are keyed
+    # on the measurator family, a hash of the data and the configuration, and hold every result
+    # measured so far, intermediates included. Least recently used entries are evicted once the
+    # results held exceed max_bytes.
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Copies, such as those sent to worker processes, start out empty
+    def __getstate__(self):
+        return { 'max_bytes': self.max_bytes }
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def key(self, base_class, data, configuration):
+        h = hashlib.sha1()
+        h.update(base_class.__name__.encode())
+        for x in data:
+            _fingerprint(h, x)
+        h.update(repr(sorted((k, v) for k, v in configuration.items() if k != 'cache')).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return {}
+
+            state, size = self._entries.pop(key)
+            self._entries[key] = state, size
+            return dict(state)
+
+    def put(self, key, state):
+        size = _nbytes(state)
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = dict(state), size
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,57 @@
+import numpy
+
+# Results are stored under their measurement key, with sequences that don't form a single array,
+# such as histograms or the per-capture results of a batch, stored an item at a time under
+# 'key/0', 'key/1' and so on
+_separator = '/'
+
+
+def _flatten(name, value, arrays):
+    if value is None:
+        return
+
+    if isinstance(value, (list, tuple)):
+        try:
+            a = numpy.asarray(value)
+        except ValueError:
+            a = None
+        if a is None or a.dtype == object:
+            for i, v in enumerate(value):
+                _flatten(name + _separator + str(i), v, arrays)
+            return
+        value = a
+
+    arrays[name] = numpy.asarray(value)
+
+
+def save_npz(file, results, compressed=False):
+    # Writes measurement results to an .npz file, straight from the arrays that hold them.
+    # Missing (None) results are left out.
+    arrays = {}
+    for k, v in results.items():
+        _flatten(k, v, arrays)
+
+    (numpy.savez_compressed if compressed else numpy.savez)(file, **arrays)
+
+
+def load_npz(file):
+    # Reads results written by save_npz, with itemised sequences back as lists and single values
+    # back as scalars
+    results = {}
+    with numpy.load(file) as f:
+        for name in f.files:
+            value = f[name]
+            path = name.split(_separator)
+            node = results
+            for p in path[:-1]:
+                node = node.setdefault(p, {})
+            node[path[-1]] = value[()] if value.ndim == 0 else value
+
+    def rebuild(node):
+        if not isinstance(node, dict):
+            return node
+        if all(k.isdigit() for k in node):
+            return [ rebuild(node[str(i)]) if str(i) in node else None for i in range(max(int(k) for k in node) + 1) ]
+        return dict((k, rebuild(v)) for k, v in node.items())
+
+    return dict((k, rebuild(v)) for k, v in results.items())
@@ -3,12 +3,34 @@ import numpy
 from math import floor, ceil, sqrt, pi
 
 from wai._base import _Measurator, _BaseMeasurementSet
+from wai._histogram import _bin_count, _range, _counts, _row_histogram
+
+import warnings
 
 default_configuration = {
     'histogram bins' : 'sqrt',
+    'cache' : None,
+    'workers' : None,
+    'profile' : None,
+    'profile memory' : False,
     'peak method' : 'cwt',
     'peak ratio' : 10,
     'peak width' : 5,
+    'peak prominence' : 10,
+    'peak distance' : 1,
+    'peak interpolation' : 'optimize',
+    'noise floor method' : 'histogram',
+    'noise floor percentile' : 50,
+    'noise profile bins' : None,
+    'peak width interpolation' : 'linear',
+    'sample rate' : None,
+    'spectrum window' : 'flattop',
+    'spectrum segment' : None,
+    'spectrum overlap' : 0.5,
+    'spectrum padding' : False,
+    'spectrum scaling' : 'spectrum',
+    'harmonic span' : None,
+    'harmonics' : None,
 }
 
 def _interp_max(x, y, start=None):
@@ -27,6 +49,52 @@ def _interp_max(x, y, start=None):
     m = minimize(i, start, method='SLSQP', bounds=[(x[0] + bw / 2, x[-1] - bw / 2)])
     return (m.x[0], -i(m.x[0]))
 
+def _interp_peaks(x, y, idxs, method, rows=None):
+    # Sub-bin position and level of each of the peaks at idxs, from the vertex of a parabola
+    # through the peak and its neighbours. 'gaussian' fits the parabola to log(y), exact for a
+    # Gaussian peak shape and close for most window main lobes. Peaks on the ends of the spectrum,
+    # or that aren't local maxima, are left at their sample. For 2-D y, rows gives the row of
+    # each peak, and x may also have a row per row of y.
+    x = numpy.asarray(x)
+    y = numpy.asarray(y, dtype=float)
+    idxs = numpy.asarray(idxs, dtype=int)
+
+    def at(v, j):
+        return v[j] if v.ndim == 1 else v[rows, j]
+
+    i = numpy.clip(idxs, 1, y.shape[-1] - 2)
+    a, b, c = at(y, i - 1), at(y, i), at(y, i + 1)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if method == 'gaussian':
+            a, b, c = numpy.log(a), numpy.log(b), numpy.log(c)
+        elif method != 'parabolic':
+            raise Exception("Unknown peak interpolation method %s" % method)
+
+        curve = a - 2 * b + c
+        fit = (idxs == i) & (curve < 0) & numpy.isfinite(curve)
+        p = numpy.where(fit, 0.5 * (a - c) / numpy.where(fit, curve, 1), 0)
+        p = numpy.clip(p, -1, 1)
+
+        level = b - 0.25 * (a - c) * p
+        if method == 'gaussian':
+            level = numpy.exp(level)
+
+    freq = at(x, i) + p * (at(x, i + 1) - at(x, i - 1)) / 2
+    return numpy.where(fit, freq, at(x, idxs)), numpy.where(fit, level, at(y, idxs))
+
+
+def _noise_percentile(y, percentile):
+    # Mean noise power from a percentile of the bins along the last axis, found by partitioning
+    # rather than sorting. Noise power in a bin is exponentially distributed, so its q'th
+    # percentile is -log(1 - q) times the mean. Peaks only take up the top few bins, so leave
+    # anything but high percentiles alone.
+    y = numpy.asarray(y, dtype=float)
+    k = int(round(percentile / 100. * (y.shape[-1] - 1)))
+    level = numpy.partition(y, k, axis=-1)[..., k]
+    return level / -numpy.log(1 - percentile / 100.)
+
+
 class _FrequencyMeasurator(_Measurator):
     pass
 
@@ -36,19 +104,70 @@ class Histogram(_FrequencyMeasurator):
     requires = []
 
     def measure(self, data, state, configuration):
-        bins = configuration['histogram bins']
-        state['histogram'] = numpy.histogram(data[0], bins=bins)
-
-        count, amp = numpy.histogram(numpy.log(data[0]), bins=bins)
-        amp = numpy.exp(amp)
+        # Both histograms come from one pass over the spectrum
+        x = numpy.asarray(data[0])
+        if not x.min() > 0:
+            raise ValueError("The log histogram needs positive powers, not %s" % x.min())
 
-        state['log histogram'] = numpy.array([count, amp])
+        bins = configuration['histogram bins']
+        if numpy.ndim(bins):
+            # Explicit bin edges serve for both the powers and their logarithms
+            state['histogram'] = numpy.histogram(x, bins=bins)
+            count, edges = numpy.histogram(numpy.log(x), bins=bins)
+            state['log histogram'] = (count, numpy.exp(edges))
+            return
+
+        bins = _bin_count(bins, len(x), x)
+
+        lo, hi = _range(x.min(), x.max())
+        log_lo, log_hi = numpy.exp(_range(numpy.log(x.min()), numpy.log(x.max())))
+        count, log_count = _counts(x, [(lo, hi, bins, False), (log_lo, log_hi, bins, True)])
+
+        state['histogram'] = (count, numpy.linspace(lo, hi, bins + 1))
+        state['log histogram'] = (log_count, numpy.exp(numpy.linspace(numpy.log(log_lo), numpy.log(log_hi), bins + 1)))
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0], dtype=float)
+        if not y.min() > 0:
+            raise ValueError("The log histogram needs positive powers, not %s" % y.min())
+
+        try:
+            bins = _bin_count(configuration['histogram bins'], y.shape[1])
+        except Exception:
+            # Bin counts that depend on the data may differ from row to row
+            histograms = []
+            for row in y:
+                s = {}
+                self.measure([row, data[1]], s, configuration)
+                histograms.append(s)
+            state['histogram'] = [ h['histogram'] for h in histograms ]
+            state['log histogram'] = [ h['log histogram'] for h in histograms ]
+            return
+
+        count, edges = _row_histogram(y, y.min(axis=1), y.max(axis=1), bins)
+        log_y = numpy.log(y)
+        log_count, log_edges = _row_histogram(log_y, log_y.min(axis=1), log_y.max(axis=1), bins)
+
+        state['histogram'] = list(zip(count, edges))
+        state['log histogram'] = list(zip(log_count, numpy.exp(log_edges)))
 
 class NoiseFloor(_FrequencyMeasurator):
     provides = ['noise floor']
     requires = ['histogram']
 
+    @classmethod
+    def requirements(cls, configuration):
+        # The percentile estimate works from the spectrum itself
+        return [] if configuration['noise floor method'] == 'percentile' else cls.requires
+
     def measure(self, data, state, configuration):
+        method = configuration['noise floor method']
+        if method == 'percentile':
+            state['noise floor'] = _noise_percentile(data[0], configuration['noise floor percentile'])
+            return
+        elif method != 'histogram':
+            raise Exception("Unknown noise floor method %s" % method)
+
         from scipy.optimize import minimize
         from scipy.interpolate import interp1d
 
@@ -56,7 +175,62 @@ class NoiseFloor(_FrequencyMeasurator):
         h = state['log histogram']
         bin_width = h[1][1] - h[1][0]
         xs = h[1][:-1] + bin_width / 2
-        state['noise floor'] = _interp_max(xs, h[0])[0]
+
+        method = configuration['peak interpolation']
+        if method == 'optimize':
+            state['noise floor'] = _interp_max(xs, h[0])[0]
+        else:
+            state['noise floor'] = _interp_peaks(xs, h[0], [numpy.argmax(h[0])], method)[0][0]
+
+    def measure_batch(self, data, state, configuration):
+        method = configuration['noise floor method']
+        if method == 'percentile':
+            state['noise floor'] = _noise_percentile(data[0], configuration['noise floor percentile'])
+            return
+        elif method != 'histogram':
+            raise Exception("Unknown noise floor method %s" % method)
+
+        counts = numpy.array([ h[0] for h in state['log histogram'] ])
+        edges = numpy.array([ h[1] for h in state['log histogram'] ])
+        xs = edges[:, :-1] + (edges[:, 1:2] - edges[:, :1]) / 2
+
+        method = configuration['peak interpolation']
+        if method == 'optimize':
+            state['noise floor'] = numpy.array([ _interp_max(x, c)[0] for x, c in zip(xs, counts) ])
+        else:
+            rows = numpy.arange(len(counts))
+            state['noise floor'] = _interp_peaks(xs, counts, numpy.argmax(counts, axis=1), method, rows)[0]
+
+
+class NoiseProfile(_FrequencyMeasurator):
+    # Noise floor of each bin, for spectra whose noise isn't flat. Percentiles are taken over
+    # blocks of 'noise profile bins' bins and interpolated between block centres in log power.
+    # Without a block size the profile is the flat noise floor.
+    provides = ['noise profile']
+    requires = ['noise floor']
+
+    def measure(self, data, state, configuration):
+        s = { 'noise floor': numpy.array([state['noise floor']]) }
+        self.measure_batch([numpy.asarray(data[0])[None, :], data[1]], s, configuration)
+        state['noise profile'] = s['noise profile'][0]
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0], dtype=float)
+        rows, n = y.shape
+        size = configuration['noise profile bins']
+        if size is None or size >= n:
+            state['noise profile'] = numpy.repeat(numpy.asarray(state['noise floor'], dtype=float)[:, None], n, axis=1)
+            return
+
+        blocks = n // size
+        floors = numpy.log(_noise_percentile(y[:, :blocks * size].reshape(rows, blocks, size), configuration['noise floor percentile']))
+
+        # Linear interpolation in log power between block centres, flat beyond the end ones
+        position = numpy.clip((numpy.arange(n) - (size - 1) / 2.) / size, 0, blocks - 1)
+        left = numpy.minimum(position.astype(int), max(blocks - 2, 0))
+        right = numpy.minimum(left + 1, blocks - 1)
+        w = position - left
+        state['noise profile'] = numpy.exp(floors[:, left] * (1 - w) + floors[:, right] * w)
 
 class PeakLevel(_FrequencyMeasurator):
     provides = ['peak level', 'peak frequency', 'peak idx']
@@ -64,7 +238,25 @@ class PeakLevel(_FrequencyMeasurator):
 
     def measure(self, data, state, configuration):
         state['peak idx'] = numpy.argmax(data[0])
-        state['peak frequency'], state['peak level'] = _interp_max(data[1], data[0], start=state['peak idx'])
+
+        method = configuration['peak interpolation']
+        if method == 'optimize':
+            state['peak frequency'], state['peak level'] = _interp_max(data[1], data[0], start=state['peak idx'])
+        else:
+            freqs, levels = _interp_peaks(data[1], data[0], [state['peak idx']], method)
+            state['peak frequency'], state['peak level'] = freqs[0], levels[0]
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        state['peak idx'] = numpy.argmax(y, axis=1)
+
+        method = configuration['peak interpolation']
+        if method == 'optimize':
+            peaks = [ _interp_max(data[1], row, start=i) for row, i in zip(y, state['peak idx']) ]
+            state['peak frequency'], state['peak level'] = numpy.array(peaks).T
+        else:
+            rows = numpy.arange(len(y))
+            state['peak frequency'], state['peak level'] = _interp_peaks(data[1], y, state['peak idx'], method, rows)
 
 class PeakSNR(_FrequencyMeasurator):
     provides = ['snr']
@@ -73,6 +265,9 @@ class PeakSNR(_FrequencyMeasurator):
     def measure(self, data, state, configuration):
         state['snr'] = state['peak level'] / state['noise floor']
 
+    def measure_batch(self, data, state, configuration):
+        self.measure(data, state, configuration)
+
 
 class OccupiedBW(_FrequencyMeasurator):
     provides = ['occupied bw']
@@ -95,16 +290,35 @@ class OccupiedBW(_FrequencyMeasurator):
 
         state['occupied bw'] = f_high - f_low
 
+    def measure_batch(self, data, state, configuration):
+        # Every row's cumulative power, normalised and offset by its row number, is increasing
+        # as one flat array, so one searchsorted finds the threshold crossings of all rows
+        x = numpy.asarray(data[1], dtype=float)
+        cum_power = numpy.cumsum(numpy.square(numpy.asarray(data[0], dtype=float)), axis=1)
+        rows, n = cum_power.shape
+        cum_power /= cum_power[:, -1:]
+        cum_power += numpy.arange(rows)[:, None]
+        flat = cum_power.ravel()
+
+        def crossing(fraction):
+            target = numpy.arange(rows) + fraction
+            j = numpy.searchsorted(flat, target) - numpy.arange(rows) * n
+            j = numpy.clip(j, 1, n - 1)
+            before, after = cum_power[numpy.arange(rows), j - 1], cum_power[numpy.arange(rows), j]
+            return x[j - 1] + (target - before) / (after - before) * (x[j] - x[j - 1])
+
+        state['occupied bw'] = crossing(0.995) - crossing(0.005)
+
 class Peaks(_FrequencyMeasurator):
     provides = ['peak freqs', 'peak idxs', 'peak amplitudes', 'peak snrs']
-    requires = ['noise floor']
+    requires = ['noise floor', 'noise profile']
 
     def by_ratio(self, data, state, configuration):
         from scipy.signal import argrelmax
-        threshold = configuration['peak ratio'] * state['noise floor']
+        threshold = configuration['peak ratio'] * state['noise profile']
 
         candidates = argrelmax(data[0])[0]
-        state['peak idxs'] = [ p for p in candidates if data[0][p] > threshold ]
+        state['peak idxs'] = [ p for p in candidates if data[0][p] > threshold[p] ]
 
     def by_cwt(self, data, state, configuration):
         from scipy.signal import find_peaks_cwt
@@ -114,62 +328,291 @@ class Peaks(_FrequencyMeasurator):
 
         state['peak idxs'] = find_peaks_cwt(data[0], w)
 
+    def by_prominence(self, data, state, configuration):
+        # Local maxima that stand out from the spectrum around them by a factor of at least
+        # 'peak prominence' and from the noise floor by 'peak ratio', no closer than
+        # 'peak distance' bins. Working with log power makes both tests ratios.
+        from scipy.signal import find_peaks
+        y = numpy.log(numpy.asarray(data[0], dtype=float) + numpy.finfo(float).tiny)
+
+        state['peak idxs'] = find_peaks(y,
+            height=numpy.log(configuration['peak ratio'] * state['noise profile']),
+            prominence=numpy.log(configuration['peak prominence']),
+            distance=configuration['peak distance'])[0]
+
     def measure(self, data, state, configuration):
         method = configuration['peak method']
         if method == 'ratio':
             self.by_ratio(data, state, configuration)
         elif method == 'cwt':
             self.by_cwt(data, state, configuration)
+        elif method == 'prominence':
+            self.by_prominence(data, state, configuration)
         else:
             raise Exception("Unknown peak detection method %s" % method)
 
-        if len(state['peak idxs']):
+        interpolation = configuration['peak interpolation']
+        if len(state['peak idxs']) and interpolation == 'optimize':
             state['peak freqs'], state['peak amplitudes'] = zip(*[ _interp_max(data[1], data[0], start=s) for s in data[1][state['peak idxs']]])
-            state['peak snrs'] = [a / state['noise floor'] for a in state['peak amplitudes']]
+            state['peak snrs'] = [a / n for a, n in zip(state['peak amplitudes'], state['noise profile'][state['peak idxs']])]
+        elif len(state['peak idxs']):
+            state['peak freqs'], state['peak amplitudes'] = _interp_peaks(data[1], data[0], state['peak idxs'], interpolation)
+            state['peak snrs'] = state['peak amplitudes'] / state['noise profile'][state['peak idxs']]
         else:
             state['peak freqs'], state['peak amplitudes'], state['peak snrs'] = None, None, None
 
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0], dtype=float)
+        profile = state['noise profile']
+
+        method = configuration['peak method']
+        if method == 'ratio':
+            from scipy.signal import argrelmax
+            rows, idxs = argrelmax(y, axis=1)
+            keep = y[rows, idxs] > configuration['peak ratio'] * profile[rows, idxs]
+            rows, idxs = rows[keep], idxs[keep]
+        elif method in ['cwt', 'prominence']:
+            # Neither search has a vectorised form, so they run row by row
+            find = self.by_cwt if method == 'cwt' else self.by_prominence
+            found = []
+            for row, row_profile in zip(y, profile):
+                s = { 'noise profile': row_profile }
+                find([row, data[1]], s, configuration)
+                found.append(numpy.asarray(s['peak idxs'], dtype=int))
+            rows = numpy.repeat(numpy.arange(len(y)), [ len(f) for f in found ])
+            idxs = numpy.concatenate(found)
+        else:
+            raise Exception("Unknown peak detection method %s" % method)
+
+        interpolation = configuration['peak interpolation']
+        if interpolation == 'optimize':
+            x = numpy.asarray(data[1])
+            peaks = [ _interp_max(x, y[r], start=x[i]) for r, i in zip(rows, idxs) ]
+            freqs, amplitudes = numpy.array(peaks, dtype=float).reshape(-1, 2).T
+        else:
+            freqs, amplitudes = _interp_peaks(data[1], y, idxs, interpolation, rows)
+        snrs = amplitudes / profile[rows, idxs]
+
+        # Per-row peak lists, with None for rows without peaks as a single spectrum would have
+        split = numpy.searchsorted(rows, numpy.arange(1, len(y)))
+        state['peak idxs'] = numpy.split(idxs, split)
+        for name, values in [('peak freqs', freqs), ('peak amplitudes', amplitudes), ('peak snrs', snrs)]:
+            state[name] = [ v if len(v) else None for v in numpy.split(values, split) ]
+
+
+def _threshold_crossings(y, idxs, thresholds, step):
+    # For each peak and threshold, the first sample beyond the peak in the direction of step that
+    # falls below the threshold, or -1 if the spectrum ends first. Scans outward through windows
+    # that double in length, only for the crossings not found yet.
+    found = -numpy.ones(thresholds.shape, dtype=int)
+    pending = numpy.ones(thresholds.shape, dtype=bool)
+
+    start, stop = 1, 8
+    while pending.any():
+        p, t = numpy.nonzero(pending)
+        j = idxs[p][:, None] + numpy.arange(start, stop + 1) * step
+        valid = (j >= 0) & (j < len(y))
+        below = valid & (y[numpy.clip(j, 0, len(y) - 1)] < thresholds[p, t][:, None])
+
+        hit = below.any(axis=1)
+        found[p[hit], t[hit]] = j[hit, numpy.argmax(below[hit], axis=1)]
+        done = hit | ~valid[:, -1]
+        pending[p[done], t[done]] = False
+
+        start, stop = stop + 1, stop * 2
+
+    return found
+
+
+def _crossing_positions(x, y, a, thresholds, kind, rows=None):
+    # Position on the x-axis where the spectrum crosses each threshold between samples a and a + 1,
+    # interpolating linearly or with the cubic through the two samples either side. For 2-D y,
+    # rows gives the row of each crossing.
+    def at(v, j):
+        return v[j] if v.ndim == 1 else v[rows, j]
+
+    y0, y1 = at(y, a), at(y, a + 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s = numpy.clip((thresholds - y0) / (y1 - y0), 0, 1)
+
+    if kind == 'cubic':
+        ym1, y2 = at(y, numpy.maximum(a - 1, 0)), at(y, numpy.minimum(a + 2, y.shape[-1] - 1))
+        c1 = -ym1 / 3 - y0 / 2 + y1 - y2 / 6
+        c2 = ym1 / 2 - y0 + y1 / 2
+        c3 = (y2 - ym1) / 6 + (y0 - y1) / 2
+
+        # Newton's method from the linear estimate
+        for _ in range(4):
+            f = y0 + s * (c1 + s * (c2 + s * c3)) - thresholds
+            df = c1 + s * (2 * c2 + 3 * s * c3)
+            s = numpy.clip(s - numpy.where(df != 0, f / numpy.where(df != 0, df, 1), 0), 0, 1)
+    elif kind != 'linear':
+        raise Exception("Unknown peak width interpolation %s" % kind)
+
+    return x[a] + s * (x[a + 1] - x[a])
+
 
 class PeakWidths(_FrequencyMeasurator):
     provides = ['peak 3dB', 'peak 6dB', 'peak occupied']
-    requires = ['peak idxs', 'peak amplitudes', 'noise floor']
+    requires = ['peak idxs', 'peak amplitudes', 'noise profile']
 
-    def _width(self, data, idx, threshold):
-        from scipy.interpolate import interp1d
-        from scipy.optimize import minimize
+    def _widths(self, data, idxs, thresholds, kind):
+        # Width of each peak at each of its thresholds, NaN where the spectrum ends before the
+        # peak falls below the threshold
+        x, y = numpy.asarray(data[1]), numpy.asarray(data[0], dtype=float)
 
-        i = interp1d(data[1], data[0], kind='cubic')
-        left = minimize(lambda x: (i(x) - threshold)**2, idx - 2)
-        right = minimize(lambda x: (i(x) - threshold)**2, idx + 2)
+        left = _threshold_crossings(y, idxs, thresholds, -1)
+        right = _threshold_crossings(y, idxs, thresholds, 1)
+        ok = (left >= 0) & (right >= 0)
 
-        return right.x - left.x
+        widths = numpy.full(thresholds.shape, numpy.nan)
+        widths[ok] = _crossing_positions(x, y, right[ok] - 1, thresholds[ok], kind) - \
+                     _crossing_positions(x, y, left[ok], thresholds[ok], kind)
+        return widths
 
     def measure(self, data, state, configuration):
-        state['peak 3dB'] = [ self._width(data, i, p / 2) for i, p in zip(state['peak idxs'], state['peak amplitudes']) ]
-        state['peak 6dB'] = [ self._width(data, i, p / 4) for i, p in zip(state['peak idxs'], state['peak amplitudes']) ]
-        state['peak occupied'] = [ self._width(data, i, state['noise floor']) for i in state['peak idxs'] ]
+        if state['peak amplitudes'] is None:
+            state['peak 3dB'], state['peak 6dB'], state['peak occupied'] = None, None, None
+            return
+
+        idxs = numpy.asarray(state['peak idxs'], dtype=int)
+        amplitudes = numpy.asarray(state['peak amplitudes'], dtype=float)
+        thresholds = numpy.stack([amplitudes / 2, amplitudes / 4, state['noise profile'][idxs]], axis=1)
+
+        widths = self._widths(data, idxs, thresholds, configuration['peak width interpolation'])
+        state['peak 3dB'], state['peak 6dB'], state['peak occupied'] = widths.T
+
+    def measure_batch(self, data, state, configuration):
+        x, y = numpy.asarray(data[1]), numpy.asarray(data[0], dtype=float)
+        n = y.shape[1]
+
+        counts = [ len(i) for i in state['peak idxs'] ]
+        rows = numpy.repeat(numpy.arange(len(y)), counts)
+        idxs = numpy.concatenate([ numpy.asarray(i, dtype=int) for i in state['peak idxs'] ])
+        amplitudes = numpy.concatenate([ a for a in state['peak amplitudes'] if a is not None ] or [[]])
+        thresholds = numpy.stack([amplitudes / 2, amplitudes / 4, state['noise profile'][rows, idxs]], axis=1)
+
+        # Scan every row at once through a flat copy with a column of -inf closing each row,
+        # which stops the scans at the row ends. Stopping there means no crossing was found.
+        padded = numpy.full((len(y), n + 1), -numpy.inf)
+        padded[:, :n] = y
+        flat = padded.ravel()
+        starts = rows * (n + 1) + idxs
+        left = _threshold_crossings(flat, starts, thresholds, -1)
+        right = _threshold_crossings(flat, starts, thresholds, 1)
+        left, right = left - rows[:, None] * (n + 1), right - rows[:, None] * (n + 1)
+        ok = (left >= 0) & (left < n) & (right >= 0) & (right < n)
+
+        kind = configuration['peak width interpolation']
+        r = numpy.repeat(rows[:, None], 3, axis=1)[ok]
+        widths = numpy.full(thresholds.shape, numpy.nan)
+        widths[ok] = _crossing_positions(x, y, right[ok] - 1, thresholds[ok], kind, r) - \
+                     _crossing_positions(x, y, left[ok], thresholds[ok], kind, r)
+
+        split = numpy.cumsum(counts)[:-1]
+        for i, name in enumerate(['peak 3dB', 'peak 6dB', 'peak occupied']):
+            state[name] = [ w if len(w) else None for w in numpy.split(widths[:, i], split) ]
+
+
+# Half-width, in bins, of the main lobe of a tone seen through each window
+_window_spans = {
+    'boxcar' : 1,
+    'hann' : 2,
+    'hamming' : 2,
+    'blackman' : 3,
+    'blackmanharris' : 4,
+    'nuttall' : 4,
+    'flattop' : 5,
+}
+
 
 class Distortion(_FrequencyMeasurator):
-    provides = ['thd']
-    requires = ['peak frequency', 'peak amplitude']
+    # Harmonic analysis of a single tone in a power spectrum. The power of the fundamental and of
+    # each harmonic up to the end of the spectrum is summed over the span of bins its window
+    # spreads it across, a bin wider each side, and the fundamental's falling skirt beyond that
+    # counts as the fundamental. Everything else other than DC counts as noise. thd and thd+n are
+    # in dB relative to the fundamental, sfdr is in dB over the largest harmonic, or the largest
+    # other bin against the fundamental's peak bin, sinad is in dB and enob in bits.
+    provides = ['fundamental frequency', 'fundamental power', 'harmonic freqs', 'harmonic powers',
+                'thd', 'thd+n', 'sinad', 'sfdr', 'enob']
+    requires = ['peak idx']
 
     def measure(self, data, state, configuration):
-        from scipy.interpolate import interp1d
-        from scipy.optimize import minimize
-        signal_power = state['peak amplitude']**2 # power = volts^2
-        f = 2 * state['peak frequency']
-        harmonic_power = 0
-
-        i = interp1d(data[1], data[0])
-
-        while f < data[1][-1]:
-            harmonic_power += i(f)**2
-            f += state['peak frequency']
-
-        if harmonic_power == 0:
-            state['thd'] = None
-        else:
-            state['thd'] = signal_power / harmonic_power
+        p, f = numpy.asarray(data[0], dtype=float), numpy.asarray(data[1], dtype=float)
+        n = len(p)
+        df = f[1] - f[0]
+
+        span = configuration['harmonic span']
+        if span is None:
+            span = _window_spans.get(configuration['spectrum window'], 5)
+
+        # Powers over [lo, hi) from the running sum
+        sums = numpy.r_[0, numpy.cumsum(p)]
+
+        def band(centres):
+            # Bins within span of each centre, in fractional bins, rounded outward and widened
+            # by a bin each side for the skirts of tones between bins
+            lo = numpy.clip(numpy.floor(centres - span).astype(int) - 1, 0, n)
+            hi = numpy.clip(numpy.ceil(centres + span).astype(int) + 2, 0, n)
+            return lo, hi
+
+        k = int(state['peak idx'])
+        lo, hi = band(numpy.array([k]))
+        f0 = numpy.dot(p[lo[0]:hi[0]], f[lo[0]:hi[0]]) / (sums[hi[0]] - sums[lo[0]])
+
+        # The fundamental's band, centred on its refined frequency
+        c = (f0 - f[0]) / df
+        lo, hi = band(numpy.array([c]))
+        lo, hi = lo[0], hi[0]
+        fundamental = sums[hi] - sums[lo]
+
+        orders = numpy.arange(2, int(f[-1] / f0) + 1)
+        if configuration['harmonics'] is not None:
+            orders = orders[:configuration['harmonics']]
+        h_lo, h_hi = band((orders * f0 - f[0]) / df)
+
+        # Low harmonics of a fundamental only a few bins up may overlap its band or each other's,
+        # so each band starts no earlier than the end of the one below it
+        below = numpy.maximum.accumulate(numpy.r_[hi, h_hi[:-1]])
+        if (h_lo < below).any():
+            warnings.warn("Harmonic bands overlap, the fundamental is too few bins up for the window", RuntimeWarning)
+        h_lo = numpy.maximum(h_lo, below)
+        h_hi = numpy.maximum(h_hi, h_lo)
+        harmonics = sums[h_hi] - sums[h_lo]
+
+        # The fundamental's skirt, the bins either side of its band over which the power keeps
+        # falling, is leakage from the fundamental rather than noise. It stops short of the
+        # harmonics.
+        rising = numpy.flatnonzero(p[hi:] >= p[hi - 1:-1])
+        falling = numpy.flatnonzero(p[:lo] >= p[1:lo + 1])
+        skirt_lo = falling[-1] + 1 if len(falling) else 0
+        skirt_hi = min(hi + rising[0] if len(rising) else n, h_lo[0] if len(h_lo) else n)
+        fundamental = sums[skirt_hi] - sums[skirt_lo]
+
+        # Bins that belong to neither DC nor the fundamental
+        other = numpy.ones(n, dtype=bool)
+        other[skirt_lo:skirt_hi] = False
+        other[:max(0, int(numpy.ceil(span + 1 - f[0] / df)) + 1)] = False
+
+        noise = p[other].sum()
+
+        # Harmonics are compared with the fundamental as band powers, which don't depend on where
+        # the tones fall between bins, and any other spur by its peak bin
+        spurs = other.copy()
+        for a, b in zip(h_lo, h_hi):
+            spurs[a:b] = False
+        spur = p[spurs].max() if spurs.any() else 0.
+
+        state['fundamental frequency'], state['fundamental power'] = f0, fundamental
+        state['harmonic freqs'], state['harmonic powers'] = orders * f0, harmonics
+
+        with numpy.errstate(divide='ignore'):
+            state['thd'] = 10 * numpy.log10(harmonics.sum() / fundamental)
+            state['thd+n'] = 10 * numpy.log10(noise / fundamental)
+            state['sfdr'] = min(10 * numpy.log10(p[k] / spur),
+                                10 * numpy.log10(fundamental / harmonics.max()) if len(harmonics) else numpy.inf)
+        state['sinad'] = -state['thd+n']
+        state['enob'] = (state['sinad'] - 1.76) / 6.02
 
 
 class FrequencyMeasurementSet(_BaseMeasurementSet):
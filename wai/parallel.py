@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import tempfile
+
+import numpy
+
+from wai._base import _samples_only
+from wai.timebase import TimeBase
+
+# Each worker maps the file holding every capture once, when it starts
+_buffer = None
+
+# Captures start on cache line boundaries in the shared file
+_align = 64
+
+
+def _attach(path):
+    global _buffer
+    _buffer = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+
+
+def _view(layout):
+    # Uniform time bases are sent as they are
+    if isinstance(layout, TimeBase):
+        return layout
+
+    offset, dtype, shape = layout
+    return numpy.frombuffer(_buffer, dtype=dtype, count=int(numpy.prod(shape)), offset=offset).reshape(shape)
+
+
+def _measure_one(task):
+    measurement_set, layouts, measurements, configuration = task
+    try:
+        data = [ _view(l) for l in layouts ]
+        return measurement_set(data if len(data) == 2 else data[0], configuration).measure(measurements)
+    except Exception as e:
+        return e
+
+
+def _shared_dir():
+    # Memory backed where available, so the file never has to reach a disk
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def measure_many(captures, measurements='all', configuration={}, workers=None, measurement_set=None):
+    # Measure each capture in a pool of worker processes, returning the results in the same order
+    # as the captures. A capture that fails to measure gives its exception in place of a result
+    # rather than stopping the others. Sample arrays reach the workers through a memory mapped file
+    # rather than being pickled.
+    if measurement_set is None:
+        from wai.timeseries import TimeSeriesMeasurementSet as measurement_set
+
+    arrays = []
+    for c in captures:
+        if _samples_only(c):
+            c = [c]
+        arrays.append([ a if isinstance(a, TimeBase) else numpy.asarray(a) for a in c ])
+
+    layouts, size = [], 0
+    for capture in arrays:
+        layout = []
+        for a in capture:
+            if isinstance(a, TimeBase):
+                layout.append(a)
+                continue
+            layout.append((size, a.dtype, a.shape))
+            size += -(-a.nbytes // _align) * _align
+        layouts.append(layout)
+
+    if not len(arrays):
+        return []
+
+    fd, path = tempfile.mkstemp(prefix='wai-', dir=_shared_dir())
+    os.close(fd)
+    try:
+        shared = numpy.memmap(path, dtype=numpy.uint8, mode='w+', shape=(max(size, 1),))
+        for capture, layout in zip(arrays, layouts):
+            for a, l in zip(capture, layout):
+                if not isinstance(a, TimeBase):
+                    shared[l[0]:l[0] + a.nbytes] = numpy.ascontiguousarray(a).view(numpy.uint8).ravel()
+        shared.flush()
+        del shared
+
+        tasks = [ (measurement_set, layout, measurements, configuration) for layout in layouts ]
+
+        pool = multiprocessing.Pool(workers, _attach, (path,))
+        try:
+            return pool.map(_measure_one, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.unlink(path)
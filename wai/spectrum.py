@@ -0,0 +1,147 @@
+import numpy
+
+from wai._base import _samples_only
+from wai.frequency import FrequencyMeasurementSet, default_configuration
+from wai.timebase import TimeBase
+
+try:
+    from scipy.fft import rfft, rfftfreq
+except ImportError:
+    from numpy.fft import rfft, rfftfreq
+
+# Windows by name and length, with the sums needed to scale spectra taken with them
+_windows = {}
+_max_windows = 64
+
+
+def _window(name, n):
+    key = (name, n)
+    if key not in _windows:
+        from scipy.signal import get_window
+        if len(_windows) >= _max_windows:
+            _windows.clear()
+        w = get_window(name, n)
+        _windows[key] = w, w.sum(), numpy.dot(w, w)
+
+    return _windows[key]
+
+
+def _fft_size(n, padding):
+    return 1 << (n - 1).bit_length() if padding else n
+
+
+def _configuration(configuration):
+    config = {}
+    config.update(default_configuration)
+    config.update(configuration)
+    return config
+
+
+def _sample_rate(data, configuration):
+    # Samples and their times, or samples alone at the configured sample rate
+    if _samples_only(data):
+        rate = configuration['sample rate']
+        return numpy.asarray(data), rate if rate else 1.
+
+    y, t = numpy.asarray(data[0]), data[1]
+    if isinstance(t, TimeBase):
+        return y, 1. / t.dt
+    return y, 1. / (t[1] - t[0])
+
+
+def _segments(y, segment, overlap):
+    # Overlapping segments along the last axis of y, as a view
+    if segment is None or segment >= y.shape[-1]:
+        return y[..., None, :]
+
+    step = segment - int(segment * overlap)
+    count = (y.shape[-1] - segment) // step + 1
+    shape = y.shape[:-1] + (count, segment)
+    strides = y.strides[:-1] + (y.strides[-1] * step, y.strides[-1])
+    return numpy.lib.stride_tricks.as_strided(y, shape, strides, writeable=False)
+
+
+def _power(segments, configuration, fs):
+    # Summed one-sided power of each segment, scaled as scipy.signal.periodogram scales it
+    n = segments.shape[-1]
+    w, s1, s2 = _window(configuration['spectrum window'], n)
+    nfft = _fft_size(n, configuration['spectrum padding'])
+
+    x = segments - segments.mean(axis=-1, keepdims=True)
+    x *= w
+    p = numpy.square(numpy.abs(rfft(x, nfft, axis=-1))).sum(axis=-2)
+
+    scaling = configuration['spectrum scaling']
+    if scaling == 'spectrum':
+        p /= s1 ** 2
+    elif scaling == 'density':
+        p /= fs * s2
+    else:
+        raise Exception("Unknown spectrum scaling %s" % scaling)
+
+    p[..., 1:nfft - nfft // 2] *= 2
+    return p, rfftfreq(nfft, 1. / fs)
+
+
+def spectrum(data, configuration={}):
+    # One-sided power spectrum of samples, given with their times or alone at 'sample rate',
+    # as [power, frequencies]. With a 'spectrum segment' length this averages the spectra of
+    # segments overlapping by 'spectrum overlap', as scipy.signal.welch does, and otherwise it is
+    # the periodogram of the whole capture. A 2-D sample array gives one spectrum per row.
+    config = _configuration(configuration)
+    y, fs = _sample_rate(data, config)
+
+    segments = _segments(numpy.asarray(y, dtype=float), config['spectrum segment'], config['spectrum overlap'])
+    p, f = _power(segments, config, fs)
+    return [p / segments.shape[-2], f]
+
+
+def frequency_measurement_set(data, configuration={}):
+    # Measurement set over the spectrum of samples. The DC bin is left out, being all but empty
+    # once the mean is taken off.
+    p, f = spectrum(data, configuration)
+    return FrequencyMeasurementSet([p[..., 1:], f[1:]], configuration)
+
+
+def measure(measurement, data, configuration={}):
+    return frequency_measurement_set(data, configuration).measure([measurement])[measurement]
+
+
+class SpectrumStream(object):
+    # Welch averaged spectrum of samples arriving a chunk at a time. Each complete segment is
+    # transformed as it arrives, so only the samples of a partial segment are held between chunks.
+    def __init__(self, sample_rate, configuration={}):
+        self.configuration = _configuration(configuration)
+        self.sample_rate = sample_rate
+
+        if self.configuration['spectrum segment'] is None:
+            raise Exception("Streamed spectra need a 'spectrum segment' length")
+
+        self.segments = 0
+        self._power = None
+        self._freqs = None
+        self._tail = numpy.zeros(0)
+
+    def feed(self, chunk):
+        segment = self.configuration['spectrum segment']
+        y = numpy.concatenate((self._tail, numpy.asarray(chunk, dtype=float)))
+        if len(y) < segment:
+            self._tail = y
+            return
+
+        segments = _segments(y, segment, self.configuration['spectrum overlap'])
+        p, self._freqs = _power(segments, self.configuration, self.sample_rate)
+        self._power = p if self._power is None else self._power + p
+        self.segments += len(segments)
+
+        step = segment - int(segment * self.configuration['spectrum overlap'])
+        self._tail = y[len(segments) * step:]
+
+    def spectrum(self):
+        if not self.segments:
+            raise Exception("No complete segments yet")
+        return [self._power / self.segments, self._freqs]
+
+    def measure(self, measurements='all'):
+        p, f = self.spectrum()
+        return FrequencyMeasurementSet([p[1:], f[1:]], self.configuration).measure(measurements)
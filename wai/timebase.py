@@ -0,0 +1,57 @@
+import numpy
+
+
+class TimeBase(object):
+    # Uniformly sampled x-axis, sample i at t0 + i * dt, to pass in place of an array of times.
+    # Indexing computes times rather than reading them, so measurators can use it wherever they
+    # index into an array, and numpy.asarray() materialises it for anything else. The length is
+    # filled in from the data when it isn't given.
+    def __init__(self, t0=0., dt=1., n=None):
+        self.t0 = t0
+        self.dt = dt
+        self.n = n
+
+    @classmethod
+    def from_rate(cls, rate, t0=0., n=None):
+        return cls(t0, 1. / rate, n)
+
+    def resized(self, n):
+        return TimeBase(self.t0, self.dt, n)
+
+    def __repr__(self):
+        return 'TimeBase(t0=%r, dt=%r, n=%r)' % (self.t0, self.dt, self.n)
+
+    def __len__(self):
+        if self.n is None:
+            raise TypeError("TimeBase without a length")
+        return self.n
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            count = max(0, -((start - stop) // step))
+            return TimeBase(self.t0 + start * self.dt, self.dt * step, count)
+
+        if numpy.ndim(idx) == 0:
+            if idx < 0 and self.n is not None:
+                idx += self.n
+            if not 0 <= idx < len(self):
+                raise IndexError("TimeBase index out of range")
+        elif self.n is not None:
+            idx = numpy.asarray(idx)
+            idx = idx + self.n * (idx < 0)
+
+        return self.t0 + idx * self.dt
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.t0 + i * self.dt
+
+    def __array__(self, dtype=None, copy=None):
+        t = self.t0 + numpy.arange(len(self)) * self.dt
+        return t if dtype is None else t.astype(dtype)
+
+
+def _axis(x):
+    # Times as something that can be indexed with arrays of sample numbers
+    return x if isinstance(x, TimeBase) else numpy.asarray(x)
@@ -3,13 +3,37 @@ import numpy
 from math import floor, ceil, sqrt, pi
 
 from wai._base import _Measurator, _BaseMeasurementSet
+from wai._histogram import _bin_count, _range, _row_histogram, _code_counts, _coarsen, _concentrated, _refine
+from wai.timebase import TimeBase, _axis
 
 import warnings
 
 default_configuration = {
     'histogram bins' : 'sqrt',
+    'sample rate' : None,
+    'cache' : None,
+    'workers' : None,
+    'profile' : None,
+    'profile memory' : False,
+    'edge method' : 'vector',
+    'edge results' : 'tuple',
+    'stream histogram bins' : 4096,
+    'stream levels' : None,
+    'stream levels samples' : 10000,
+    'sine fit' : 'curve_fit',
+    'sine fit iterations' : 4,
+    'sine fit decimation' : 1,
+    'sine fit cycles' : False,
+    'adc scale' : None,
+    'adc offset' : 0.,
 }
 
+# Widest span of integer codes histogrammed a bin per code
+_max_codes = 1 << 24
+
+# Most running sums kept from the start of a streamed edge in progress, for the cycle statistics
+_stream_edge_sums = 4096
+
 
 class _TimeSeriesMeasurator(_Measurator):
     pass
@@ -19,26 +43,103 @@ class Histogram(_TimeSeriesMeasurator):
     provides = ['histogram']
     requires = []
 
+    # Increase bin count, doubling up to 4 times, until no single bin in either half of the histogram
+    # contains more than 80% of that half's points. This is useful when the points are tighly concentrated
+    # around more than one point, or with significant outliers. Square waves are a good example where,
+    # without this, all the points end up in two bins: A high bin and a low bin.
+    #
+    # The data is read once, into a histogram at the finest resolution allowed, and each candidate
+    # bin count is found by merging neighbouring fine bins.
+    refinements = 4
+
+    def by_codes(self, y, lo, hi, bins, refinements):
+        # Integer samples are taken to be ADC codes. They're counted exactly, a bin per code, and
+        # the candidate bins are whole numbers of codes wide, centred on the codes, so no code is
+        # ever split between bins. Refinement stops early at a bin per code.
+        codes = _code_counts(y, lo, max(hi, lo + 1))
+
+        for level in range(refinements + 1):
+            width = -(-len(codes) // (bins * 2**level))
+            counts = _coarsen(numpy.r_[codes, numpy.zeros(-len(codes) % width, dtype=codes.dtype)], width)
+            if width == 1 or not _concentrated(counts):
+                break
+        else:
+            warnings.warn("Break before histogram corrected", RuntimeWarning)
+
+        return counts, lo - 0.5 + numpy.arange(len(counts) + 1) * width
+
     def measure(self, data, state, configuration):
+        y = numpy.asarray(data[0])
         bins = configuration['histogram bins']
-        state['histogram'] = numpy.histogram(data[0], bins=bins)
-        for _ in range(4):
-            # Iteratively increase bin count, up to 4 times, until no single bin in either half of the histogram
-            # contains more than 80% of that half's points. This is useful when the points are tighly concentrated
-            # around more than one point, or with significant outliers. Square waves are a good example where,
-            # without this, all the points end up in two bins: A high bin and a low bin.
-            h = list(zip(*state['histogram']))
-            bin_step = h[1][1] - h[0][1]
-            split = int(len(h) / 2)
-            bottom = h[:split]
-            top = h[split:]
-            if max(bottom)[0] < 0.8*(sum(state['histogram'][0][:split])) and max(top)[0] < 0.8*(sum(state['histogram'][0][split:])):
-                break
-            bins = len(h) * 2
-            state['histogram'] = numpy.histogram(data[0], bins=bins)
+        refinements = self.refinements
+
+        if numpy.ndim(bins):
+            # Explicit bin edges are used as they are unless the points are concentrated, when
+            # refinement carries on from twice as many equal-width bins
+            counts, edges = numpy.histogram(y, bins=bins)
+            if not _concentrated(counts):
+                state['histogram'] = (counts, edges)
+                return
+            bins, refinements = 2 * len(counts), refinements - 1
         else:
+            bins = _bin_count(bins, len(y), y)
+
+        if y.dtype.kind in 'iu' and int(y.max()) - int(y.min()) < _max_codes:
+            state['histogram'] = self.by_codes(y, int(y.min()), int(y.max()), bins, refinements)
+            return
+
+        lo, hi = _range(y.min(), y.max())
+
+        fine = numpy.histogram(y, bins=bins * 2**refinements, range=(lo, hi))[0]
+        levels, failed = _refine(fine, refinements)
+        if failed:
             warnings.warn("Break before histogram corrected", RuntimeWarning)
 
+        bins *= 2**levels
+        state['histogram'] = (_coarsen(fine, 2**(refinements - levels)), numpy.linspace(lo, hi, bins + 1))
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        lo, hi = y.min(axis=1), y.max(axis=1)
+
+        if numpy.ndim(configuration['histogram bins']):
+            histograms = []
+            for row in y:
+                s = {}
+                self.measure([row, data[1]], s, configuration)
+                histograms.append(s['histogram'])
+            state['histogram'] = histograms
+            return
+
+        histograms = [None] * len(y)
+        row_bins = numpy.array([ _bin_count(configuration['histogram bins'], y.shape[1], row) for row in y ])
+
+        for bins in numpy.unique(row_bins):
+            rows = numpy.flatnonzero(row_bins == bins)
+            fine, edges = _row_histogram(y[rows], lo[rows], hi[rows], bins * 2**self.refinements)
+            levels, failed = _refine(fine, self.refinements)
+            if failed.any():
+                warnings.warn("Break before histogram corrected", RuntimeWarning)
+
+            for i, f, e, level in zip(rows, fine, edges, levels):
+                factor = 2**(self.refinements - level)
+                histograms[i] = (_coarsen(f, factor), e[::factor])
+
+        state['histogram'] = histograms
+
+
+def _histogram_levels(counts, edges):
+    # Centres of the most populated bin in the bottom and top half of each row's histogram. Ties
+    # go to the higher bin, matching max() over (count, edge) tuples.
+    split = int(counts.shape[1] / 2)
+    bin_step = edges[:, 1] - edges[:, 0]
+    rows = numpy.arange(len(counts))
+
+    low = split - 1 - numpy.argmax(counts[:, split - 1::-1], axis=1)
+    high = counts.shape[1] - 1 - numpy.argmax(counts[:, :split - 1:-1], axis=1)
+
+    return edges[rows, low] + bin_step / 2, edges[rows, high] + bin_step / 2
+
 
 class Levels(_TimeSeriesMeasurator):
     provides = ['high level', 'low level', 'amplitude', 'rms', 'peak-peak', 'mean', 'std']
@@ -60,8 +161,29 @@ class Levels(_TimeSeriesMeasurator):
         state['low level'] = max(bottom)[1] + bin_step / 2
         state['high level'] = max(top)[1] + bin_step / 2
         state['amplitude'] = state['high level'] - state['low level']
-        state['peak-peak'] = max(data[0]) - min(data[0])
-        state['rms'] = sqrt(mean(square(data[0])))
+        state['peak-peak'] = float(numpy.max(data[0])) - numpy.min(data[0])
+        state['rms'] = sqrt(mean(square(data[0], dtype=float)))
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        histograms = state['histogram']
+        low, high = numpy.empty(len(y)), numpy.empty(len(y))
+
+        bins = numpy.array([ len(h[0]) for h in histograms ])
+        for b in numpy.unique(bins):
+            rows = numpy.flatnonzero(bins == b)
+            low[rows], high[rows] = _histogram_levels(
+                numpy.array([ histograms[i][0] for i in rows ]),
+                numpy.array([ histograms[i][1] for i in rows ]))
+
+        state['mean'] = numpy.average(y, axis=1)
+        state['std'] = numpy.std(y, axis=1)
+
+        state['low level'] = low
+        state['high level'] = high
+        state['amplitude'] = high - low
+        state['peak-peak'] = y.max(axis=1).astype(float) - y.min(axis=1)
+        state['rms'] = numpy.sqrt(numpy.mean(numpy.square(y, dtype=float), axis=1))
 
 
 class Shoot(_TimeSeriesMeasurator):
@@ -69,28 +191,124 @@ class Shoot(_TimeSeriesMeasurator):
     requires = ['high level', 'low level']
 
     def measure(self, data, state, configuration):
-        state['overshoot'] = max(data[0]) - state['high level']
-        state['undershoot'] = min(data[0]) - state['low level']
+        state['overshoot'] = numpy.max(data[0]) - state['high level']
+        state['undershoot'] = numpy.min(data[0]) - state['low level']
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        state['overshoot'] = y.max(axis=1) - state['high level']
+        state['undershoot'] = y.min(axis=1) - state['low level']
+
+
+def _crossing(d1, d2, t1, t2, threshold):
+    # Sub-sample interpolation of the crossing between samples (t1, d1) and (t2, d2)
+    r = (d2 - threshold) / (numpy.asarray(d2, dtype=float) - d1)
+    return r * t2 + (1 - r) * t1
+
+
+def _edge_points(d, t, low_thres, high_thres):
+    # Edges for each row of d, where the thresholds hold one value per row.
+    #
+    # The per-sample state machine in Edges.by_loop is a Schmitt trigger: it flips low when the
+    # signal enters the region below the low threshold and high when it enters the region above
+    # the high threshold. Each edge starts at the first exit from the region the trigger was in
+    # and ends where the trigger flips. Only region entries and exits are materialised, as flat
+    # positions into d, so everything past the threshold comparisons scales with the edge count.
+    n = d.shape[1]
+    flat = d.ravel()
+
+    low = d <= low_thres[:, None]
+    high = d > high_thres[:, None]
+
+    def leaves(region):
+        rows, cols = numpy.nonzero(region[:, :-1] & ~region[:, 1:])
+        return rows * n + cols
+
+    def entries(region):
+        rows, cols = numpy.nonzero(~region[:, :-1] & region[:, 1:])
+        return numpy.union1d(rows * n + cols + 1, numpy.flatnonzero(region[:, 0]) * n)
+
+    leave_low, leave_high = leaves(low), leaves(high)
+    enter_low, enter_high = entries(low), entries(high)
+
+    entered = numpy.concatenate((enter_low, enter_high))
+    is_high = numpy.concatenate((numpy.zeros(len(enter_low), dtype=bool), numpy.ones(len(enter_high), dtype=bool)))
+    order = numpy.argsort(entered, kind='mergesort')
+    entered, is_high = entered[order], is_high[order]
+
+    # Collapse repeated entries into the same region, leaving only the trigger flips
+    runs = numpy.flatnonzero(numpy.diff(is_high) | numpy.diff(entered // n).astype(bool)) + 1
+    runs = numpy.r_[0, runs] if len(entered) else runs
+    run_start, run_high, run_row = entered[runs], is_high[runs], entered[runs] // n
+
+    def crossing_times(idx, threshold):
+        col = idx % n
+        return _crossing(flat[idx], flat[idx + 1], t[col], t[col + 1], threshold)
+
+    def edges(from_high, leave, threshold, end_threshold):
+        first = numpy.flatnonzero((run_high[:-1] == from_high) & (run_row[:-1] == run_row[1:]))
+        start = leave[numpy.searchsorted(leave, run_start[first])]
+        end = run_start[first + 1] - 1
+        rows = run_row[first]
+
+        start_t = crossing_times(start, threshold[rows])
+        end_t = crossing_times(end, end_threshold[rows])
+        return rows, (end % n + start % n) // 2, (end_t + start_t) / 2, end_t - start_t
+
+    # Where the edge in progress at the end of each row started: the first exit from the region
+    # entered at the last trigger flip, or -1 if the signal hasn't left that region yet
+    pending = -numpy.ones(len(d), dtype=int)
+    last = numpy.flatnonzero(numpy.r_[run_row[1:] != run_row[:-1], True]) if len(runs) else runs
+    for from_high, leave in [(False, leave_low), (True, leave_high)]:
+        ends = last[run_high[last] == from_high]
+        exits = numpy.searchsorted(leave, run_start[ends])
+        left = exits < len(leave)
+        ends, exits = ends[left], exits[left]
+        left = leave[exits] // n == run_row[ends]
+        pending[run_row[ends[left]]] = leave[exits[left]]
+
+    return (edges(False, leave_low, low_thres, high_thres),
+            edges(True, leave_high, high_thres, low_thres),
+            pending)
+
+
+def _row_stats(rows, x, n):
+    # Mean and standard deviation of x grouped by row, NaN for rows without entries
+    count = numpy.bincount(rows, minlength=n)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.bincount(rows, x, minlength=n) / count
+        std = numpy.sqrt(numpy.bincount(rows, numpy.square(x - mean[rows]), minlength=n) / count)
+    return mean, std
+
+
+def _edge_results(idx, times, durations, results):
+    # Per-edge results in the form 'edge results' asks for: tuples of Python numbers, or arrays
+    if results == 'array':
+        return numpy.asarray(idx, dtype=int), numpy.asarray(times, dtype=float), numpy.asarray(durations, dtype=float)
+    elif results == 'tuple' and not len(idx):
+        return [], [], []
+    elif results == 'tuple':
+        return tuple(numpy.asarray(idx).tolist()), tuple(numpy.asarray(times).tolist()), tuple(numpy.asarray(durations).tolist())
+    else:
+        raise Exception("Unknown edge results %s" % results)
 
 
 class Edges(_TimeSeriesMeasurator):
-    provides = ['rising edge', 'falling edge', 'rising edge idx', 'falling edge idx',
+    provides = ['rising edge', 'falling edge', 'rising edge idx', 'falling edge idx', 'rise times', 'fall times',
         'rise time', 'fall time', 'rise time std', 'fall time std',
         'rise rate', 'fall rate', 'rise rate std', 'fall rate std']
     requires = ['high level', 'low level']
 
-    def measure(self, data, state, configuration):
-        low_thres = state['low level'] + 0.1 * (state['high level'] - state['low level'])
-        high_thres = state['low level'] + 0.9 * (state['high level'] - state['low level'])
-
-        edge_height = high_thres - low_thres
-
+    def by_loop(self, data, low_thres, high_thres):
         rising_points = []
         falling_points = []
 
+        # As Python numbers, so differences of integer codes can't overflow
+        y = numpy.asarray(data[0]).tolist()
+
         detect_state = 'start'
         last = (0,0)
-        for i, d1, d2, t1, t2 in zip(range(len(data[0])), data[0], data[0][1:], data[1], data[1][1:]):
+        for i, d1, d2, t1, t2 in zip(range(len(y)), y, y[1:], data[1], data[1][1:]):
             if d1 <= low_thres and d2 > low_thres and detect_state in ['rising low', 'start']:
                 r = (d2 - low_thres) / (d2 - d1)
                 t = r * t2 + (1 - r) * t1
@@ -114,11 +332,36 @@ class Edges(_TimeSeriesMeasurator):
                 falling_points.append((int((i + li) / 2), (t + lt) / 2, t - lt))
                 detect_state = 'rising low'
 
-        state['rising edge idx'], state['rising edge'], rise_time = zip(*rising_points) if len(rising_points) else ([], [], [])
-        state['falling edge idx'], state['falling edge'], fall_time = zip(*falling_points) if len(falling_points) else ([], [], [])
+        return (list(zip(*rising_points)) or ([], [], []),
+                list(zip(*falling_points)) or ([], [], []))
+
+    def by_vector(self, data, low_thres, high_thres):
+        d = numpy.asarray(data[0])[None, :]
+        t = _axis(data[1])
+        rising, falling, _ = _edge_points(d, t, numpy.array([low_thres]), numpy.array([high_thres]))
 
-        rise_time = numpy.array(rise_time)
-        fall_time = numpy.array(fall_time)
+        return rising[1:], falling[1:]
+
+    def measure(self, data, state, configuration):
+        low_thres = state['low level'] + 0.1 * (state['high level'] - state['low level'])
+        high_thres = state['low level'] + 0.9 * (state['high level'] - state['low level'])
+
+        edge_height = high_thres - low_thres
+
+        method = configuration['edge method']
+        if method == 'vector':
+            rising, falling = self.by_vector(data, low_thres, high_thres)
+        elif method == 'loop':
+            rising, falling = self.by_loop(data, low_thres, high_thres)
+        else:
+            raise Exception("Unknown edge detection method %s" % method)
+
+        results = configuration['edge results']
+        state['rising edge idx'], state['rising edge'], state['rise times'] = _edge_results(rising[0], rising[1], rising[2], results)
+        state['falling edge idx'], state['falling edge'], state['fall times'] = _edge_results(falling[0], falling[1], falling[2], results)
+
+        rise_time = numpy.array(rising[2], dtype=float)
+        fall_time = numpy.array(falling[2], dtype=float)
 
         state['rise time'], state['rise time std'] = (numpy.average(rise_time), numpy.std(rise_time)) if len(rise_time) else ([], [])
         state['fall time'], state['fall time std'] = (numpy.average(fall_time), numpy.std(fall_time)) if len(fall_time) else ([], [])
@@ -126,6 +369,60 @@ class Edges(_TimeSeriesMeasurator):
         state['rise rate'], state['rise rate std'] = (numpy.average(edge_height / rise_time), numpy.std(edge_height / rise_time)) if len(rise_time) else ([], [])
         state['fall rate'], state['fall rate std'] = (numpy.average(edge_height / fall_time), numpy.std(edge_height / fall_time)) if len(fall_time) else ([], [])
 
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        t = _axis(data[1])
+        n = len(y)
+
+        low_thres = state['low level'] + 0.1 * (state['high level'] - state['low level'])
+        high_thres = state['low level'] + 0.9 * (state['high level'] - state['low level'])
+        edge_height = high_thres - low_thres
+
+        rising, falling, _ = _edge_points(y, t, low_thres, high_thres)
+
+        for name, duration, (rows, idx, times, durations) in [('rising', 'rise', rising), ('falling', 'fall', falling)]:
+            split = numpy.searchsorted(rows, numpy.arange(1, n))
+            state[name + ' edge idx'] = numpy.split(idx, split)
+            state[name + ' edge'] = numpy.split(times, split)
+            state[duration + ' times'] = numpy.split(durations, split)
+
+        state['rise time'], state['rise time std'] = _row_stats(rising[0], rising[3], n)
+        state['fall time'], state['fall time std'] = _row_stats(falling[0], falling[3], n)
+
+        state['rise rate'], state['rise rate std'] = _row_stats(rising[0], edge_height[rising[0]] / rising[3], n)
+        state['fall rate'], state['fall rate std'] = _row_stats(falling[0], edge_height[falling[0]] / falling[3], n)
+
+
+_edge_table = numpy.dtype([('idx', numpy.intp), ('time', float), ('duration', float), ('slew', float)])
+_cycle_table = numpy.dtype([('idx', numpy.intp), ('time', float), ('period', float)])
+
+
+class EdgeTables(_TimeSeriesMeasurator):
+    # Per-edge and per-cycle results as structured arrays, one record per edge or per cycle
+    # between consecutive rising edges
+    provides = ['rising edge table', 'falling edge table', 'cycle table']
+    requires = ['rising edge idx', 'rising edge', 'rise times', 'falling edge idx', 'falling edge', 'fall times',
+        'high level', 'low level']
+
+    def measure(self, data, state, configuration):
+        edge_height = 0.8 * (state['high level'] - state['low level'])
+
+        for name, duration in [('rising', 'rise'), ('falling', 'fall')]:
+            table = numpy.zeros(len(state[name + ' edge idx']), dtype=_edge_table)
+            table['idx'] = state[name + ' edge idx']
+            table['time'] = state[name + ' edge']
+            table['duration'] = state[duration + ' times']
+            with numpy.errstate(divide='ignore'):
+                table['slew'] = edge_height / table['duration']
+            state[name + ' edge table'] = table
+
+        rising = state['rising edge table']
+        cycles = numpy.zeros(max(len(rising) - 1, 0), dtype=_cycle_table)
+        cycles['idx'] = rising['idx'][:-1]
+        cycles['time'] = rising['time'][:-1]
+        cycles['period'] = numpy.diff(rising['time'])
+        state['cycle table'] = cycles
+
 
 class CycleStatistics(_TimeSeriesMeasurator):
     provides = ['cycle mean', 'cycle std', 'cycle rms']
@@ -145,31 +442,58 @@ class CycleStatistics(_TimeSeriesMeasurator):
 
         state['cycle mean'] = numpy.average(trimmed)
         state['cycle std'] = numpy.std(trimmed)
-        state['cycle rms'] = sqrt(mean(square(trimmed)))
+        state['cycle rms'] = sqrt(mean(square(trimmed, dtype=float)))
+
+    def measure_batch(self, data, state, configuration):
+        y = numpy.asarray(data[0])
+        start, stop = numpy.zeros(len(y), dtype=int), numpy.zeros(len(y), dtype=int)
+        for i, (rei, fei) in enumerate(zip(state['rising edge idx'], state['falling edge idx'])):
+            if len(rei) >= 2:
+                start[i], stop[i] = rei[0], rei[-1]
+            elif len(fei) >= 2:
+                start[i], stop[i] = fei[0], fei[-1]
+
+        cols = numpy.arange(y.shape[1])
+        trimmed = (cols >= start[:, None]) & (cols < stop[:, None])
+        count = trimmed.sum(axis=1)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(trimmed, y, 0).sum(axis=1) / count
+            state['cycle mean'] = mean
+            state['cycle std'] = numpy.sqrt(numpy.where(trimmed, numpy.square(y - mean[:, None]), 0).sum(axis=1) / count)
+            state['cycle rms'] = numpy.sqrt(numpy.where(trimmed, numpy.square(y, dtype=float), 0).sum(axis=1) / count)
+
 
 class PulseStatistics(_TimeSeriesMeasurator):
-    provides = ['pos width', 'neg width', 'duty']
+    provides = ['pos width', 'neg width', 'duty', 'pos widths', 'neg widths', 'duty cycles']
     requires = ['rising edge', 'falling edge']
 
     def measure(self, data, state, configuration):
-        re = list(state['rising edge'])
-        fe = list(state['falling edge'])
+        re = numpy.asarray(state['rising edge'], dtype=float)
+        fe = numpy.asarray(state['falling edge'], dtype=float)
 
-        pos = []
-        neg = []
-
-        while len(re) and len(fe):
-            if re[0] < fe[0]:
-                pos.append(fe[0] - re[0])
-                re.pop(0)
-            else:
-                neg.append(re[0] - fe[0])
-                fe.pop(0)
+        # Each rising edge pairs with the first falling edge after it and each falling edge with
+        # the first rising edge at or after it, as merging the two edge lists in time order does
+        after = numpy.searchsorted(fe, re, 'right')
+        pos = fe[after[after < len(fe)]] - re[after < len(fe)]
+        after = numpy.searchsorted(re, fe, 'left')
+        neg = re[after[after < len(re)]] - fe[after < len(re)]
 
+        state['pos widths'], state['neg widths'] = pos, neg
         state['pos width'] = numpy.average(pos) if len(pos) else None
         state['neg width'] = numpy.average(neg) if len(neg) else None
         state['duty'] = state['pos width'] / (state['pos width'] + state['neg width']) if state['pos width'] and state['neg width'] else None
 
+        # Duty cycle of each cycle between consecutive rising edges, NaN where the cycle has no
+        # falling edge
+        duty = numpy.full(max(len(re) - 1, 0), numpy.nan)
+        if len(duty) and len(fe):
+            falls = numpy.searchsorted(fe, re[:-1], 'right')
+            ok = falls < len(fe)
+            ok[ok] = fe[falls[ok]] < re[1:][ok]
+            duty[ok] = (fe[falls[ok]] - re[:-1][ok]) / numpy.diff(re)[ok]
+        state['duty cycles'] = duty
+
 class CycleParameters(_TimeSeriesMeasurator):
     provides = ['frequency', 'period']
     requires = ['rising edge', 'falling edge']
@@ -180,10 +504,10 @@ class CycleParameters(_TimeSeriesMeasurator):
 
         pr, pf = None, None
         if len(re) >= 2:
-            pr = numpy.average([ b - a for a, b in zip(re, re[1:]) ])
+            pr = numpy.average(numpy.diff(re))
 
         if len(fe) >= 2:
-            pf = numpy.average([ b - a for a, b in zip(fe, fe[1:]) ])
+            pf = numpy.average(numpy.diff(fe))
 
         p = (pr + pf) / 2 if pr and pf else pr or pf
 
@@ -193,36 +517,161 @@ class CycleParameters(_TimeSeriesMeasurator):
         state['period'] = p
 
 
+class Jitter(_TimeSeriesMeasurator):
+    # Timing of the rising edges against a clock. Period jitter is the standard deviation of the
+    # periods and cycle-to-cycle jitter the RMS change from one period to the next. The time
+    # interval error of each edge is its offset from an ideal clock fitted to all of them by
+    # least squares.
+    provides = ['periods', 'period jitter', 'cycle-to-cycle jitter', 'tie', 'tie rms', 'tie peak-peak']
+    requires = ['rising edge']
+
+    def measure(self, data, state, configuration):
+        re = numpy.asarray(state['rising edge'], dtype=float)
+        periods = numpy.diff(re)
+
+        state['periods'] = periods
+        state['period jitter'] = numpy.std(periods) if len(periods) else None
+        state['cycle-to-cycle jitter'] = numpy.sqrt(numpy.mean(numpy.square(numpy.diff(periods)))) if len(periods) >= 2 else None
+
+        if len(re) < 2:
+            state['tie'], state['tie rms'], state['tie peak-peak'] = numpy.zeros(len(re)), None, None
+            return
+
+        # Closed-form line fit of edge time against cycle number
+        k = numpy.arange(len(re)) - (len(re) - 1) / 2.
+        period = numpy.dot(k, re) / numpy.dot(k, k)
+        tie = re - (numpy.mean(re) + k * period)
+
+        state['tie'] = tie
+        state['tie rms'] = numpy.sqrt(numpy.mean(numpy.square(tie)))
+        state['tie peak-peak'] = tie.max() - tie.min()
+
+
 class SineParameters(_TimeSeriesMeasurator):
     provides = ['sine frequency', 'sine offset', 'sine phase', 'sine amplitude']
-    requires = ['frequency', 'period', 'cycle mean', 'amplitude', 'rising edge']
+    requires = ['frequency', 'period', 'cycle mean', 'amplitude', 'rising edge', 'rising edge idx']
 
-    def measure(self, data, state, configuration):
+    def by_curve_fit(self, x, y, state):
         from scipy.optimize import curve_fit
 
         def sine_objective(x, freq, amplitude, phase, offset):
             return numpy.sin(x * freq * 2 * pi + phase) * amplitude + offset
 
-        # Don't try and fit a sine if we don't have an estimated period, i.e. at least
-        # one complete cycle
-        if state['period']:
-            est_phase = state['rising edge'][0] / state['period'] * 2 * pi
-        else:
-            state['sine frequency'], state['sine amplitude'], state['sine phase'], state['sine offset'] = None, None, None, None
-            return
-
+        est_phase = state['rising edge'][0] / state['period'] * 2 * pi
         p0 = [state['frequency'], state['amplitude'], est_phase, state['cycle mean']]
 
         try:
-            fit = curve_fit(sine_objective, data[1], data[0], p0)[0]
+            fit = curve_fit(sine_objective, x, y, p0)[0]
             if fit[1] < 0:
                 fit[2] += pi
                 fit[1] *= -1
         except RuntimeError:
             fit = None, None, None, None
 
+        return fit
+
+    def by_least_squares(self, x, y, state, iterations):
+        # Three parameter linear least squares fit of a sin(wx) + b cos(wx) + c at the frequency
+        # measured from the edges. Each iteration then also fits a frequency correction, from the
+        # first order term x (a cos(wx) - b sin(wx)), as in the IEEE 1057 four parameter fit.
+        w = 2 * pi * state['frequency']
+        ones = numpy.ones(len(x))
+
+        for i in range(iterations + 1):
+            s, c = numpy.sin(w * x), numpy.cos(w * x)
+            columns = numpy.stack([s, c, ones] + ([x * (a * c - b * s)] if i else []))
+
+            # Solve the normal equations, the columns being few and far from collinear
+            fit = numpy.linalg.solve(numpy.dot(columns, columns.T), numpy.dot(columns, y))
+
+            a, b, offset = fit[:3]
+            if i:
+                w += fit[3]
+                if abs(fit[3]) < 1e-12 * abs(w):
+                    break
+
+        return w / (2 * pi), numpy.hypot(a, b), numpy.arctan2(b, a), offset
+
+    def measure(self, data, state, configuration):
+        # Don't try and fit a sine if we don't have an estimated period, i.e. at least
+        # one complete cycle
+        if not state['period']:
+            state['sine frequency'], state['sine amplitude'], state['sine phase'], state['sine offset'] = None, None, None, None
+            return
+
+        x, y = data[1], numpy.asarray(data[0])
+
+        rei = state['rising edge idx']
+        if configuration['sine fit cycles'] and len(rei) >= 2:
+            x, y = x[rei[0]:rei[-1]], y[rei[0]:rei[-1]]
+
+        # Only the samples fitted are given times, when the time base is uniform
+        step = configuration['sine fit decimation']
+        x, y = numpy.asarray(x[::step]), y[::step]
+
+        method = configuration['sine fit']
+        if method == 'curve_fit':
+            fit = self.by_curve_fit(x, y, state)
+        elif method == 'linear':
+            fit = self.by_least_squares(x, y, state, 0)
+        elif method == 'iterative':
+            fit = self.by_least_squares(x, y, state, configuration['sine fit iterations'])
+        else:
+            raise Exception("Unknown sine fit method %s" % method)
+
         state['sine frequency'], state['sine amplitude'], state['sine phase'], state['sine offset'] = fit
 
+# Measurements scaled from ADC codes as levels, as differences of levels and as spreads
+_adc_levels = ['high level', 'low level', 'mean', 'cycle mean', 'sine offset']
+_adc_differences = ['amplitude', 'peak-peak', 'overshoot', 'undershoot', 'rise rate', 'fall rate',
+                    'std', 'cycle std', 'rise rate std', 'fall rate std', 'sine amplitude']
+
+
+def _adc_map(value, f):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [ _adc_map(v, f) for v in value ]
+    return f(value)
+
+
+def _adc_scaled(state, configuration):
+    # Measurements made on ADC codes, scaled to the units of 'adc scale' per code plus
+    # 'adc offset'. Times and counts are unaffected, so only the sample valued results change.
+    scale, offset = configuration['adc scale'], configuration['adc offset']
+    if scale is None and not offset:
+        return state
+    scale = 1. if scale is None else scale
+    if scale <= 0:
+        raise Exception("ADC scale must be positive, not %s" % scale)
+
+    def slew(table):
+        table = table.copy()
+        table['slew'] *= scale
+        return table
+
+    scaled = dict(state)
+    for k in _adc_levels:
+        if k in state:
+            scaled[k] = _adc_map(state[k], lambda v: v * scale + offset)
+    for k in _adc_differences:
+        if k in state:
+            scaled[k] = _adc_map(state[k], lambda v: v * scale)
+    if 'histogram' in state:
+        scaled['histogram'] = _adc_map(state['histogram'], lambda h: (h[0], h[1] * scale + offset))
+    for k in ['rising edge table', 'falling edge table']:
+        if k in state:
+            scaled[k] = _adc_map(state[k], slew)
+
+    # The mean square of scaled samples follows from the mean and mean square of the codes
+    for rms, mean in [('rms', 'mean'), ('cycle rms', 'cycle mean')]:
+        if rms in state:
+            scaled[rms] = numpy.sqrt(numpy.square(scale * numpy.asarray(state[rms])) +
+                                     2 * scale * offset * numpy.asarray(state[mean]) + offset ** 2)
+
+    return scaled
+
+
 class TimeSeriesMeasurementSet(_BaseMeasurementSet):
     def __init__(self, data, configuration={}):
         config = {}
@@ -234,5 +683,307 @@ class TimeSeriesMeasurementSet(_BaseMeasurementSet):
             data,
             config)
 
+    def _scale(self, state):
+        return _adc_scaled(state, self.configuration)
+
+class TimeSeriesStream(object):
+    def __init__(self, configuration={}):
+        config = {}
+        config.update(default_configuration)
+        config.update(configuration)
+        self.configuration = config
+
+        # Running moments of every sample seen
+        self.count = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self._sumsq = 0.
+        self._min = None
+        self._max = None
+
+        # Histogram of fixed-width bins, bin k covering [k * width, (k + 1) * width). The width
+        # doubles, merging neighbouring bins, whenever the data outgrows 'stream histogram bins'.
+        self._hist = numpy.zeros(0, dtype=numpy.int64)
+        self._hist_first = 0
+        self._hist_width = None
+
+        # Bin rules that need the points themselves, rather than running statistics, can't be used
+        bins = config['histogram bins']
+        if not numpy.ndim(bins) and not isinstance(bins, int) and bins not in ['sqrt', 'sturges', 'rice', 'scott', 'fd', 'auto']:
+            raise Exception("Streams can't choose histogram bins by %s" % bins)
+
+        # Edge thresholds, fixed from the first 'stream levels samples' samples unless configured.
+        # Chunks wait here until there are that many.
+        self._levels = config['stream levels']
+        self._waiting = []
+        self._received = 0
+
+        # The last sample, its index and the sums of every sample before it, so edges can span
+        # chunks. An edge in progress is held as (from high, start index, start time, sums, step),
+        # with the running sums from its start at every step samples.
+        self._last = None
+        self._last_idx = 0
+        self._before = numpy.zeros(2)
+        self._pending = None
+
+        self._edges = { 'rising': [], 'falling': [] }
+
+        # Sums up to the first and most recent edge of each kind, for the cycle statistics
+        self._cycle = { 'rising': None, 'falling': None }
+
+    def _add_moments(self, d):
+        n, mean = len(d), numpy.average(d)
+        m2 = numpy.sum(numpy.square(d - mean))
+
+        delta = mean - self._mean
+        total = self.count + n
+        self._mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.count * n / total
+        self._sumsq += numpy.dot(d, d) if d.dtype.kind == 'f' else numpy.square(d, dtype=float).sum()
+        self.count = total
+
+        self._min = d.min() if self._min is None else min(self._min, d.min())
+        self._max = d.max() if self._max is None else max(self._max, d.max())
+
+    def _add_histogram(self, d):
+        max_bins = self.configuration['stream histogram bins']
+        if self._hist_width is None:
+            span = float(d.max()) - d.min()
+            self._hist_width = span / (max_bins / 4) if span else 1.
+
+        while True:
+            k = numpy.floor(d / self._hist_width).astype(numpy.int64)
+            first, last = k.min(), k.max()
+            if len(self._hist):
+                first, last = min(first, self._hist_first), max(last, self._hist_first + len(self._hist) - 1)
+            if last - first < max_bins:
+                break
+
+            merged = numpy.arange(self._hist_first, self._hist_first + len(self._hist)) // 2
+            self._hist = numpy.bincount(merged - merged[0], self._hist).astype(numpy.int64)
+            self._hist_first = merged[0]
+            self._hist_width *= 2
+
+        hist = numpy.bincount(k - first, minlength=last - first + 1)
+        hist[self._hist_first - first:self._hist_first - first + len(self._hist)] += self._hist
+        self._hist, self._hist_first = hist, first
+
+    def _add_found(self, name, idx, times, durations, sums):
+        self._edges[name].append((idx, times, durations))
+
+        if self._cycle[name] is None:
+            self._cycle[name] = (idx[0], sums[:, 0], None, None)
+        self._cycle[name] = self._cycle[name][:2] + (idx[-1], sums[:, -1])
+
+    def _edge_sums(self, kept, step, start, first, sums):
+        # Extend the sums kept from an edge's start with those of this window, which starts at
+        # sample first. The step doubles, dropping every other sum, to keep at most
+        # _stream_edge_sums of them.
+        skip = start + kept.shape[1] * step - first
+        kept = numpy.concatenate((kept, sums[:, skip::step]), axis=1)
+        while kept.shape[1] > _stream_edge_sums:
+            kept, step = kept[:, ::2], step * 2
+        return kept, step
+
+    def _add_edges(self, d, t):
+        low, high = self._levels
+        low_thres = low + 0.1 * (high - low)
+        high_thres = low + 0.9 * (high - low)
+
+        if self._last is not None:
+            d = numpy.concatenate(([self._last[0]], d))
+            t = numpy.concatenate(([self._last[1]], t))
+        first = self._last_idx
+
+        # Running sums of the samples and their squares, up to each sample
+        sums = numpy.zeros((2, len(d) + 1))
+        numpy.cumsum(d, out=sums[0, 1:])
+        numpy.cumsum(numpy.square(d, dtype=float), out=sums[1, 1:])
+        sums += self._before[:, None]
+
+        if self._pending is not None:
+            from_high, start, start_t, kept, step = self._pending
+            kept, step = self._edge_sums(kept, step, start, first, sums)
+
+            # The edge in progress ends just before the signal enters the opposite region
+            entered = numpy.flatnonzero(d[1:] <= low_thres if from_high else d[1:] > high_thres)
+            if not len(entered):
+                self._pending = from_high, start, start_t, kept, step
+                self._last, self._last_idx, self._before = (d[-1], t[-1]), first + len(d) - 1, sums[:, len(d) - 1]
+                return
+
+            end = entered[0]
+            end_t = _crossing(d[end], d[end + 1], t[end], t[end + 1], low_thres if from_high else high_thres)
+            idx = (start + first + end) // 2
+
+            # Sums are exact in the middle of edges up to _stream_edge_sums samples long, and
+            # interpolated between the sums kept for longer ones
+            at = start + numpy.arange(kept.shape[1]) * step
+            idx_sums = numpy.array([ numpy.interp(idx, at, k) for k in kept ])
+
+            self._add_found('falling' if from_high else 'rising', numpy.array([idx]), numpy.array([(end_t + start_t) / 2]),
+                            numpy.array([end_t - start_t]), idx_sums[:, None])
+            self._pending = None
+
+            # Carry on from the entry into the opposite region, where the trigger flipped
+            d, t, sums = d[end + 1:], t[end + 1:], sums[:, end + 1:]
+            first += end + 1
+
+        rising, falling, pending = _edge_points(d[None, :], t, numpy.array([low_thres]), numpy.array([high_thres]))
+
+        for name, (_, idx, times, durations) in [('rising', rising), ('falling', falling)]:
+            if len(idx):
+                self._add_found(name, idx + first, times, durations, sums[:, idx])
+
+        p = pending[0]
+        if p >= 0:
+            from_high = d[p] > high_thres
+            start_t = _crossing(d[p], d[p + 1], t[p], t[p + 1], high_thres if from_high else low_thres)
+            self._pending = (from_high, first + p, start_t) + self._edge_sums(sums[:, :0], 1, first + p, first, sums)
+
+        self._last, self._last_idx, self._before = (d[-1], t[-1]), first + len(d) - 1, sums[:, len(d) - 1]
+
+    def feed(self, chunk):
+        if len(chunk) != 2 or numpy.ndim(chunk[0]) == 0:
+            rate = self.configuration['sample rate']
+            times = TimeBase(0., 1. / rate if rate else 1., self._received + len(chunk))
+            chunk = [chunk, times[self._received:]]
+
+        d, t = numpy.asarray(chunk[0]), numpy.asarray(chunk[1])
+        if not len(d):
+            return
+        self._received += len(d)
+
+        if self._levels is None:
+            self._waiting.append((d, t))
+            if self._received >= self.configuration['stream levels samples']:
+                self._set_levels()
+            return
+
+        self._add(d, t)
+
+    def _set_levels(self):
+        d = numpy.concatenate([ w[0] for w in self._waiting ])
+        t = numpy.concatenate([ w[1] for w in self._waiting ])
+        if len(d) < 2:
+            raise Exception("Too few samples to find the edge levels, set 'stream levels'")
+
+        # Levels in the domain of the samples, before any ADC scaling
+        levels = TimeSeriesMeasurementSet([d, t], self.configuration)
+        levels.measure(['low level', 'high level'])
+        self._levels = levels.state['low level'], levels.state['high level']
+
+        self._waiting = []
+        self._add(d, t)
+
+    def _add(self, d, t):
+        self._add_moments(d)
+        self._add_histogram(d)
+        self._add_edges(d, t)
+
+    def _bin_count(self, lo, hi):
+        # Bin count for the rules that depend on the data, as numpy.histogram_bin_edges finds it,
+        # from the running moments and the quartiles of the running histogram
+        rule, n = self.configuration['histogram bins'], self.count
+        if rule not in ['scott', 'fd', 'auto']:
+            return _bin_count(rule, n)
+
+        if rule == 'scott':
+            width = (24 * sqrt(pi) / n) ** (1. / 3) * sqrt(self._m2 / n)
+        else:
+            edges = (numpy.arange(len(self._hist) + 1) + self._hist_first) * self._hist_width
+            cdf = numpy.r_[0, numpy.cumsum(self._hist)] / float(n)
+            q1, q3 = numpy.interp([0.25, 0.75], cdf, edges)
+            width = 2 * (q3 - q1) * n ** (-1. / 3)
+            if rule == 'auto':
+                sturges = (hi - lo) / (numpy.log2(n) + 1)
+                width = min(width, sturges) if width else sturges
+
+        return int(ceil((hi - lo) / width)) if width else 1
+
+    def _histogram(self):
+        # Rebin the running histogram on to the bins a one-shot histogram of the same points would
+        # use, doubling the bin count as Histogram does but never going finer than the running bins
+        centres = (numpy.arange(len(self._hist)) + self._hist_first + 0.5) * self._hist_width
+        lo, hi = _range(self._min, self._max)
+
+        bins = self.configuration['histogram bins']
+        if numpy.ndim(bins):
+            counts = numpy.histogram(centres, bins=bins, weights=self._hist)[0].astype(numpy.int64)
+            return counts, numpy.asarray(bins, dtype=float)
+
+        bins = min(self._bin_count(lo, hi), len(self._hist))
+        for _ in range(5):
+            idx = numpy.clip(((centres - lo) / (hi - lo) * bins).astype(int), 0, bins - 1)
+            counts = numpy.bincount(idx, self._hist, minlength=bins).astype(numpy.int64)
+
+            split = int(bins / 2)
+            if bins * 2 > len(self._hist) or \
+                    (counts[:split].max() < 0.8 * counts[:split].sum() and counts[split:].max() < 0.8 * counts[split:].sum()):
+                break
+            bins *= 2
+
+        return counts, numpy.linspace(lo, hi, bins + 1)
+
+    def measure(self):
+        # Measuring before the levels were found finds them from what has been fed so far
+        if self._waiting:
+            self._set_levels()
+
+        if not self.count:
+            raise Exception("No data has been fed to the stream")
+
+        state = {}
+        state['histogram'] = self._histogram()
+        low, high = _histogram_levels(state['histogram'][0][None, :], state['histogram'][1][None, :])
+
+        state['mean'] = self._mean
+        state['std'] = sqrt(self._m2 / self.count)
+        state['rms'] = sqrt(self._sumsq / self.count)
+        state['low level'] = low[0]
+        state['high level'] = high[0]
+        state['amplitude'] = state['high level'] - state['low level']
+        state['peak-peak'] = float(self._max) - self._min
+        state['overshoot'] = self._max - state['high level']
+        state['undershoot'] = self._min - state['low level']
+
+        edge_height = 0.8 * (self._levels[1] - self._levels[0])
+        for name, duration in [('rising', 'rise'), ('falling', 'fall')]:
+            edges = self._edges[name]
+            idx, times, durations = [ numpy.concatenate(e) for e in zip(*edges) ] if len(edges) else ([], [], [])
+
+            state[name + ' edge idx'], state[name + ' edge'], state[duration + ' times'] = \
+                _edge_results(idx, times, durations, self.configuration['edge results'])
+            state[duration + ' time'], state[duration + ' time std'] = (numpy.average(durations), numpy.std(durations)) if len(idx) else ([], [])
+            state[duration + ' rate'], state[duration + ' rate std'] = (numpy.average(edge_height / durations), numpy.std(edge_height / durations)) if len(idx) else ([], [])
+
+        # As in CycleStatistics, the statistics cover whole cycles between the first and last
+        # rising edges, or falling edges if there aren't enough rising ones
+        cycle = [ self._cycle[name] for name in ['rising', 'falling'] if self._cycle[name] and self._cycle[name][0] != self._cycle[name][2] ]
+        if len(cycle):
+            first, first_sums, last, last_sums = cycle[0]
+            total, total_sq = (last_sums - first_sums) / (last - first)
+            state['cycle mean'] = total
+            state['cycle std'] = sqrt(max(total_sq - total ** 2, 0))
+            state['cycle rms'] = sqrt(total_sq)
+        else:
+            state['cycle mean'], state['cycle std'], state['cycle rms'] = numpy.nan, numpy.nan, numpy.nan
+
+        PulseStatistics().measure(None, state, self.configuration)
+        CycleParameters().measure(None, state, self.configuration)
+        Jitter().measure(None, state, self.configuration)
+
+        # Slews are over the edge height the stream's thresholds were set from
+        tables = dict(state)
+        tables['low level'], tables['high level'] = self._levels
+        EdgeTables().measure(None, tables, self.configuration)
+        for k in EdgeTables.provides:
+            state[k] = tables[k]
+
+        # The sine fit needs the whole record
+        state['sine frequency'], state['sine amplitude'], state['sine phase'], state['sine offset'] = None, None, None, None
+
+        return _adc_scaled(state, self.configuration)
+
 def measure(measurement, data, configuration={}):
     return TimeSeriesMeasurementSet(data, configuration).measure([measurement])[measurement]